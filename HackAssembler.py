@@ -1,236 +1,544 @@
-import sys
-
-ST = {
-    "R0": 0,
-    "R1": 1,
-    "R2": 2,
-    "R3": 3,
-    "R4": 4,
-    "R5": 5,
-    "R6": 6,
-    "R7": 7,
-    "R8": 8,
-    "R9": 9,
-    "R10": 10,
-    "R11": 11,
-    "R12": 12,
-    "R13": 13,
-    "R14": 14,
-    "R15": 15,
-
-    "SCREEN": 16384,
-    "KBD": 24576,
-    "SP": 0,
-    "LCL": 1,
-    "ARG": 2,
-    "THIS": 3,
-    "THAT": 4
-}
-
-
-def main():
-
-    if len(sys.argv) != 2:
-        print("Usage: python HackAssembler.py Xxx.asm")
-        sys.exit(1)
-
-    input_file = sys.argv[1]
-    # output file name is the same as input, but with .hack rather than .asm
-    output_file = input_file[:-3] + "hack"
-
-    # First Pass to add labels to ST and strip whitespace/comments
-    with open(input_file, "r") as program, open("temp.asm", "w") as temp:
-        instruction_number = 0
-
-        for line in program:
-            line = line.strip()
-
-            # ignore blank lines
-            if line == "":
-                continue
-
-            # ignore comment lines
-            if line.startswith("//"):
-                continue
-
-            # remove trailing comments
-            line = line.split("//")[0]
-
-            # Either write the clean instruction to temp, or add the label and its value to ST
-            if line.startswith("("):
-                symbol = line.split("(")[1].split(")")[0]
-                value = instruction_number
-                ST[symbol] = value
-            else:
-                temp.write(line + '\n')
-                instruction_number += 1
-
-    # Second Pass to parse and decode instructions
-    with open("temp.asm", "r") as temp, open(output_file, "w") as out:
-        n = 16
-        binary_instruction = "0000000000000000"
-
-        for instruction in temp:
-            # Check whether the instruction is an A command or C command
-            instruction = instruction.strip()
-            if instruction.startswith("@"):  # Handle A command
-                # Handle the non symbol case
-                if not is_symbol(instruction[1:]):
-                    binary_instruction = code_a_command(int(instruction[1:]))
-
-                else:  # Handle variable
-                    if instruction[1:] in ST:
-                        binary_instruction = code_a_command(ST[instruction[1:]])
-                    else:
-                        ST[instruction[1:]] = n
-                        binary_instruction = code_a_command(n)
-                        n += 1
-
-            else:  # Handle C command
-                dest, comp, jump = parser(instruction)
-                binary_instruction = code_c_command(dest, comp, jump)
-
-            # Write the binary command to the output file
-            out.write(binary_instruction + "\n")
-
-
-def is_symbol(string):
-    try:
-        int(string)
-        return False
-    except ValueError:
-        return True
-
-
-def dec_to_bin(num: int, current=''):
-    """Given a integer num, returns a string with the corresponding binary"""
-    if num < 1:
-        return current
-    current = str(num % 2) + current
-    x = dec_to_bin(num // 2, current)
-    return x
-
-
-def parser(c_instruction):
-    """Given a c instruction, returns the dest, comp, and jump components. Comp will not be None"""
-    parse1 = c_instruction.split("=")
-
-    if len(parse1) == 2:
-        dest = parse1[0].strip()
-        comp = parse1[1].split(";")[0].strip()
-    else:
-        dest = None
-        comp = parse1[0].split(";")[0].strip()
-
-    jump = c_instruction.split(";")[-1].strip()
-    # Make sure the jump statement is valid
-    if jump not in ["JEQ", "JNE", "JGT", "JGE", "JLT", "JLE", "JMP"]:
-        jump = None
-
-    return dest, comp, jump
-
-
-def code_a_command(value: int):
-    bin_val = dec_to_bin(value)
-    if len(bin_val) > 15:
-        raise Exception("A-command memory address out of range. Tried @" + str(value))
-    return "0" * (16 - len(bin_val)) + bin_val
-
-
-def code_c_command(dest, comp, jump):
-    """comp may not be None, but dest and/or jump may"""
-
-    # Encode dest
-    if dest:
-        bin_dest = "".join([
-            "1" if "A" in dest else "0",
-            "1" if "D" in dest else "0",
-            "1" if "M" in dest else "0"
-        ])
-    else:
-        bin_dest = "000"
-
-    # Encode jump
-    if jump:
-        if jump == "JMP":
-            bin_jump = "111"
-
-        elif jump == "JNE":
-            bin_jump = "101"
-
-        else:
-            bin_jump = "".join([
-                "1" if "L" in jump else "0",
-                "1" if "E" in jump else "0",
-                "1" if "G" in jump else "0",
-            ])
-    else:
-        bin_jump = "000"
-
-    # Encode comp which cannot be None
-    bin_a = "1" if "M" in comp else "0"
-    if "0" in comp:
-        bin_comp =  "101010"
-
-    elif "1" in comp:
-        if "-" in comp:
-            if "D" in comp:
-                # D - 1
-                bin_comp =  "001110"
-            elif "A" in comp or "M" in comp:
-                # A - 1 or M - 1
-                bin_comp =  "110010"
-            else:
-                # -1
-                bin_comp = "111010"
-
-        elif "+" in comp:
-            if "D" in comp:
-                # D + 1
-                bin_comp =  "011111"
-            elif "A" in comp or "M" in comp:
-                # A + 1 or M + 1
-                bin_comp = "110111"
-        else:
-            # 1
-            bin_comp = "111111"
-
-    elif "!" in comp:
-        if "D" in comp:
-            # !D
-            bin_comp = "001101"
-        else:
-            # !A or !M
-            bin_comp = "110001"
-
-    elif "&" in comp:
-        # D & A or D & M
-        bin_comp = "000000"
-
-    elif "|" in comp:
-        # D|A or D|M
-        bin_comp = "010101"
-
-    elif "D" in comp and "+" in comp:
-        # D+A or D+M
-        bin_comp = "000010"
-
-    elif "D" in comp and ("A" in comp or "M" in comp):
-        # Must be D-A, D-M, A-D, or M-D
-        if comp.index("D") < comp.index("-"):
-            bin_comp = "010011"
-        else:
-            bin_comp = "000111"
-
-    else:
-        # Must be D or A or M
-        if "D" in comp:
-            bin_comp = "001100"
-        else:
-            bin_comp = "110000"
-
-    return "111" + bin_a + bin_comp + bin_dest + bin_jump
-
-
-if __name__ == '__main__':
-    main()
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import permutations
+from types import MappingProxyType
+
+# predefined symbols, read-only so that every run has to work on its own copy
+ST = MappingProxyType({
+    "R0": 0,
+    "R1": 1,
+    "R2": 2,
+    "R3": 3,
+    "R4": 4,
+    "R5": 5,
+    "R6": 6,
+    "R7": 7,
+    "R8": 8,
+    "R9": 9,
+    "R10": 10,
+    "R11": 11,
+    "R12": 12,
+    "R13": 13,
+    "R14": 14,
+    "R15": 15,
+
+    "SCREEN": 16384,
+    "KBD": 24576,
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4
+})
+
+# comp mnemonic -> a-bit followed by the 6 c-bits, including both operand orders of commutative comps
+COMP = {
+    "0": "0101010",
+    "1": "0111111",
+    "-1": "0111010",
+    "D": "0001100",
+    "A": "0110000",
+    "!D": "0001101",
+    "!A": "0110001",
+    "-D": "0001111",
+    "-A": "0110011",
+    "D+1": "0011111",
+    "A+1": "0110111",
+    "D-1": "0001110",
+    "A-1": "0110010",
+    "D+A": "0000010",
+    "D-A": "0010011",
+    "A-D": "0000111",
+    "D&A": "0000000",
+    "D|A": "0010101",
+
+    "M": "1110000",
+    "!M": "1110001",
+    "-M": "1110011",
+    "M+1": "1110111",
+    "M-1": "1110010",
+    "D+M": "1000010",
+    "D-M": "1010011",
+    "M-D": "1000111",
+    "D&M": "1000000",
+    "D|M": "1010101",
+}
+for _comp in ["D+1", "A+1", "M+1", "D+A", "D+M", "D&A", "D&M", "D|A", "D|M"]:
+    _left, _op, _right = _comp[:-2], _comp[-2], _comp[-1]
+    COMP[_right + _op + _left] = COMP[_comp]
+
+# dest mnemonic (any order of A, D, M) -> 3 d-bits
+DEST = {"": "000"}
+for _length in range(1, 4):
+    for _dest in permutations("ADM", _length):
+        DEST["".join(_dest)] = "".join("1" if register in _dest else "0" for register in "ADM")
+
+JUMP = {"": "000", "JGT": "001", "JEQ": "010", "JGE": "011", "JLT": "100", "JNE": "101", "JLE": "110", "JMP": "111"}
+
+# every whitespace free c instruction -> its binary encoding
+C_INSTRUCTIONS = {
+    (_dest + "=" if _dest else "") + _comp + (";" + _jump if _jump else ""): "111" + _comp_bits + _dest_bits + _jump_bits
+    for _dest, _dest_bits in DEST.items()
+    for _comp, _comp_bits in COMP.items()
+    for _jump, _jump_bits in JUMP.items()
+}
+
+# a line of assembly from its first non whitespace character up to any comment, for scanning without decoding
+INSTRUCTION_LINE = re.compile(rb"^[ \t\r]*([^\s/][^\n/]*)", re.MULTILINE)
+LABEL_START = ord("(")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Assembles a hack .asm file into a .hack file")
+    arg_parser.add_argument("input_files", metavar="Xxx.asm", nargs="+",
+                            help="Xxx.asm, or - to stream from stdin to stdout. Several files are assembled as a "
+                                 "batch (in --jobs worker processes) and the time each took is reported")
+    arg_parser.add_argument("--bin", action="store_true",
+                            help="write a packed little-endian uint16 ROM image (Xxx.bin) instead of Xxx.hack")
+    ingest = arg_parser.add_mutually_exclusive_group()
+    ingest.add_argument("--mmap", action="store_true",
+                        help="memory-map the input and scan it as bytes, keeping memory use low for huge inputs")
+    ingest.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="encode the second pass in N worker processes, or assemble a batch in N processes")
+    arg_parser.add_argument("--index", action="store_true",
+                            help="also write Xxx.index.json mapping each ROM address to its source line and label")
+    arg_parser.add_argument("--optimize", action="store_true",
+                            help="run the HackOptimizer peephole rules before assembling and report what they removed")
+    arg_parser.add_argument("--benchmark", action="store_true",
+                            help="report instructions encoded per second instead of writing the .hack file")
+    args = arg_parser.parse_args()
+    if args.index and args.mmap:
+        arg_parser.error("--index is not supported with --mmap")
+    if args.optimize and (args.index or args.mmap):
+        arg_parser.error("--optimize is not supported with --index or --mmap")
+
+    if len(args.input_files) > 1:
+        if args.bin or args.mmap or args.index or args.optimize or args.benchmark or "-" in args.input_files:
+            arg_parser.error("a batch of several files only supports writing each Xxx.hack")
+        timings = Assembler().assemble_batch(args.input_files, jobs=args.jobs)
+        for input_file, seconds in timings.items():
+            print(f"{input_file}: {seconds:.3f}s")
+        print(f"total: {sum(timings.values()):.3f}s")
+        return
+
+    input_file = args.input_files[0]
+    if input_file == "-":
+        if args.bin or args.mmap or args.jobs > 1 or args.index or args.optimize or args.benchmark:
+            arg_parser.error("reading from stdin only supports writing .hack text to stdout")
+        assemble_stream(sys.stdin, sys.stdout)
+        return
+
+    # output file name is the same as input, but with .hack rather than .asm
+    output_file = input_file[:-3] + "hack"
+
+    if args.benchmark:
+        with open(input_file, "r") as program:
+            benchmark(program)
+        return
+
+    if args.mmap:
+        binary_instructions = assemble_mapped(input_file)
+    else:
+        with open(input_file, "r") as program:
+            lines = program
+            if args.optimize:
+                from HackOptimizer import optimize, print_report  # imported here as HackOptimizer imports this module
+                lines, removed = optimize(program)
+                print_report(removed, file=sys.stderr)
+            index = new_index() if args.index else None
+            binary_instructions = assemble(lines, jobs=args.jobs, index=index)
+        if index is not None:
+            write_index(input_file[:-3] + "index.json", index)
+
+    if args.bin:
+        write_rom(input_file[:-3] + "bin", to_rom_image(binary_instructions))
+        return
+
+    with open(output_file, "w") as out:
+        for binary_instruction in binary_instructions:
+            out.write(binary_instruction + "\n")
+
+
+def to_rom_image(binary_instructions):
+    """:returns array('H') of the 16-bit words given the binary instruction strings returned by assemble"""
+    return array("H", [int(binary_instruction, 2) for binary_instruction in binary_instructions])
+
+
+def write_rom(rom_file, rom_image):
+    """Writes the array('H') rom_image to rom_file as packed little-endian uint16 words"""
+    if sys.byteorder == "big":
+        rom_image = array("H", rom_image)
+        rom_image.byteswap()
+    with open(rom_file, "wb") as out:
+        rom_image.tofile(out)
+
+
+def load_rom(rom_file):
+    """:returns a read-only memoryview of uint16 words memory-mapped from a ROM image written by write_rom
+    The words are not copied unless the machine is big-endian, in which case an array('H') is returned"""
+    with open(rom_file, "rb") as rom:
+        if os.fstat(rom.fileno()).st_size == 0:
+            return memoryview(b"").cast("H")
+        mapped = mmap.mmap(rom.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == "big":
+        rom_image = array("H", mapped)
+        rom_image.byteswap()
+        return rom_image
+    return memoryview(mapped).cast("H")
+
+
+def benchmark(lines, repeat=5):
+    """Times the second pass (encoding) over lines and prints the best instructions encoded per second"""
+    symbol_table = dict(ST)
+    instructions = first_pass(lines, symbol_table)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        second_pass(instructions, dict(symbol_table))
+        best = min(best, time.perf_counter() - start)
+    print(f"{len(instructions)} instructions, {len(instructions) / best:,.0f} instructions encoded per second")
+
+
+def assemble(lines, jobs=1, index=None):
+    """:returns list of binary instruction strings given an iterable of hack assembly lines
+    Each call works on its own copy of ST, so assemble is safe to call repeatedly and concurrently
+    With jobs > 1 the second pass is split across that many worker processes
+    If index (from new_index) is given, it is filled in with the source of every ROM address"""
+    return Assembler().assemble(lines, jobs, index)
+
+
+class Assembler:
+    """Assembles hack programs. Every run starts from a fresh copy of ST, and the symbol table of the
+    last run is kept in symbol_table (labels and variables included) until the next one"""
+
+    def __init__(self):
+        self.symbol_table = dict(ST)
+
+    def assemble(self, lines, jobs=1, index=None):
+        """:returns list of binary instruction strings given an iterable of hack assembly lines"""
+        self.symbol_table = dict(ST)
+        instructions = first_pass(lines, self.symbol_table, index)
+        if jobs > 1:
+            return parallel_second_pass(instructions, self.symbol_table, jobs)
+        return second_pass(instructions, self.symbol_table)
+
+    def assemble_file(self, input_file):
+        """Assembles input_file (Xxx.asm) into Xxx.hack and :returns the seconds it took"""
+        start = time.perf_counter()
+        with open(input_file, "r") as program:
+            binary_instructions = self.assemble(program)
+        with open(input_file[:-3] + "hack", "w") as out:
+            out.write("".join(binary_instruction + "\n" for binary_instruction in binary_instructions))
+        return time.perf_counter() - start
+
+    def assemble_batch(self, input_files, jobs=1):
+        """Assembles every Xxx.asm in input_files into Xxx.hack, in this process or in a pool of jobs worker
+        processes, and :returns {input_file: seconds it took}"""
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs) as pool:
+                return dict(zip(input_files, pool.map(assemble_file, input_files)))
+        return {input_file: self.assemble_file(input_file) for input_file in input_files}
+
+
+def assemble_file(input_file):
+    """Assembles input_file with a new Assembler and :returns the seconds it took, for use in worker processes"""
+    return Assembler().assemble_file(input_file)
+
+
+def first_pass(lines, symbol_table, index=None):
+    """Adds labels to symbol_table and :returns list of the instructions stripped of whitespace/comments
+    If index (from new_index) is given, the source of each instruction and each label is recorded in it"""
+    instructions = []
+
+    for line_number, line in enumerate(lines, 1):
+        original_line = line.strip()
+        line = clean_line(line)
+        if line == "":
+            continue
+
+        # Either keep the clean instruction, or add the label and its value to symbol_table
+        if line.startswith("("):
+            symbol = line.split("(")[1].split(")")[0]
+            symbol_table[symbol] = len(instructions)
+            if index is not None:
+                index["label_addresses"].append(len(instructions))
+                index["label_names"].append(symbol)
+        else:
+            instructions.append(line)
+            if index is not None:
+                index["lines"].append(line_number)
+                index["text"].append(original_line)
+
+    return instructions
+
+
+def clean_line(line):
+    """:returns the instruction or label in line without whitespace or comments, or "" if there is none"""
+    line = line.strip()
+
+    # ignore blank lines
+    if line == "":
+        return ""
+
+    # ignore comment lines
+    if line.startswith("//"):
+        return ""
+
+    # remove trailing comments
+    line = line.split("//")[0].strip()
+    # normalize whitespace inside the instruction, such as M = D+M or D; JMP
+    if " " in line or "\t" in line:
+        line = "".join(line.split())
+    return line
+
+
+def assemble_stream(lines, out):
+    """Assembles the hack assembly lines, writing each binary instruction to out as soon as it is known
+    Only the instructions from the first one referring to a not yet defined symbol onward are held back:
+    they are written once the label is declared, or at the end of the input, when the remaining
+    undefined symbols become variables"""
+    symbol_table = dict(ST)
+    # instructions waiting on a symbol, and the address of the first of them
+    pending = []
+    pending_address = 0
+
+    for line in lines:
+        line = clean_line(line)
+        if line == "":
+            continue
+
+        if line.startswith("("):
+            symbol = line.split("(")[1].split(")")[0]
+            symbol_table[symbol] = pending_address + len(pending)
+        else:
+            pending.append(line)
+            if len(pending) > 1:
+                # held back behind an instruction that is still waiting on a symbol
+                continue
+
+        # write every instruction up to the first one still referring to an undefined symbol
+        written = 0
+        for instruction in pending:
+            binary_instruction = encode_known(instruction, symbol_table)
+            if binary_instruction is None:
+                break
+            out.write(binary_instruction + "\n")
+            written += 1
+        if written:
+            del pending[:written]
+            pending_address += written
+
+    for binary_instruction in encode_instructions(pending, symbol_table):
+        out.write(binary_instruction + "\n")
+
+
+def encode_known(instruction, symbol_table):
+    """:returns the binary encoding of instruction, or None if it refers to a symbol not in symbol_table"""
+    if instruction.startswith("@"):
+        value = instruction[1:]
+        if value in symbol_table:
+            return code_a_command(symbol_table[value])
+        if is_symbol(value):
+            return None
+        return code_a_command(int(value))
+
+    binary_instruction = C_INSTRUCTIONS.get(instruction)
+    if binary_instruction is None:
+        dest, comp, jump = parser(instruction)
+        binary_instruction = code_c_command(dest, comp, jump)
+    return binary_instruction
+
+
+def new_index():
+    """:returns an empty address-to-source index for first_pass to fill in
+    lines and text hold the .asm line number and source text of each ROM address, and
+    label_addresses/label_names hold every label in address order (so lookups can bisect them)"""
+    return {"lines": [], "text": [], "label_addresses": [], "label_names": []}
+
+
+def write_index(index_file, index):
+    with open(index_file, "w") as out:
+        json.dump(index, out, separators=(",", ":"))
+
+
+def load_index(index_file):
+    with open(index_file, "r") as index:
+        return json.load(index)
+
+
+def symbolize(index, address):
+    """:returns (line number, enclosing label or None, source text) of the instruction at ROM address
+    The label is the last one declared at or before address, found by binary search"""
+    label_position = bisect_right(index["label_addresses"], address) - 1
+    label = index["label_names"][label_position] if label_position >= 0 else None
+    return index["lines"][address], label, index["text"][address]
+
+
+def assemble_mapped(input_file):
+    """Generator of the binary instruction strings for input_file, which is memory-mapped and scanned as bytes
+    rather than decoded line by line. Only the symbol table, the offsets of the instructions and the encoding of
+    each distinct instruction are kept in memory, and both passes share the offsets found by scan_instructions"""
+    with open(input_file, "rb") as program:
+        if os.fstat(program.fileno()).st_size == 0:
+            return
+        with mmap.mmap(program.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            symbol_table = dict(ST)
+            offsets = scan_instructions(buffer, symbol_table)
+            instructions = (buffer[offsets[i]:offsets[i + 1]] for i in range(0, len(offsets), 2))
+            yield from encode_instructions(instructions, symbol_table, clean=clean_instruction)
+
+
+def scan_instructions(buffer, symbol_table):
+    """First pass over a bytes-like buffer: adds labels to symbol_table and :returns array('Q') holding the
+    start and end offset of each instruction (without its comment) one after the other"""
+    offsets = array("Q")
+    append = offsets.append
+
+    for line in INSTRUCTION_LINE.finditer(buffer):
+        start, end = line.span(1)
+        if buffer[start] == LABEL_START:
+            symbol = buffer[start + 1:end].split(b")")[0].strip()
+            symbol_table[symbol.decode()] = len(offsets) // 2
+        else:
+            append(start)
+            append(end)
+
+    return offsets
+
+
+def clean_instruction(raw_instruction):
+    """:returns the instruction str given the bytes of an instruction without its comment"""
+    instruction = raw_instruction.decode().strip()
+    # normalize whitespace inside the instruction, such as M = D+M or D; JMP
+    if " " in instruction or "\t" in instruction:
+        instruction = "".join(instruction.split())
+    return instruction
+
+
+def second_pass(instructions, symbol_table):
+    """Allocates variables in symbol_table and :returns list of the binary encoding of each instruction"""
+    return list(encode_instructions(instructions, symbol_table))
+
+
+def parallel_second_pass(instructions, symbol_table, jobs):
+    """Same result as second_pass, but variables are allocated up front by allocate_variables so that
+    chunks of instructions can be encoded independently in a pool of jobs worker processes"""
+    allocate_variables(instructions, symbol_table)
+    # a few chunks per worker keeps the workers busy when some chunks encode faster than others
+    chunk_size = max(1, -(-len(instructions) // (jobs * 4)))
+    chunks = [(start, start + chunk_size) for start in range(0, len(instructions), chunk_size)]
+
+    binary_instructions = []
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(instructions, symbol_table)) as pool:
+        for binary_chunk in pool.map(encode_chunk, chunks):
+            binary_instructions += binary_chunk
+    return binary_instructions
+
+
+def allocate_variables(instructions, symbol_table):
+    """Adds every variable to symbol_table with the address second_pass would give it (16, 17, ... by first use)"""
+    n = 16
+    for instruction in instructions:
+        if instruction.startswith("@"):
+            value = instruction[1:]
+            if value not in symbol_table and is_symbol(value):
+                symbol_table[value] = n
+                n += 1
+
+
+# set in each worker process by init_worker, so chunks are sent to workers as (start, end) ranges
+worker_instructions = []
+worker_symbol_table = {}
+
+
+def init_worker(instructions, symbol_table):
+    global worker_instructions, worker_symbol_table
+    worker_instructions = instructions
+    worker_symbol_table = symbol_table
+
+
+def encode_chunk(chunk):
+    """:returns list of the binary encoding of worker_instructions[start:end] given chunk = (start, end)"""
+    start, end = chunk
+    return second_pass(worker_instructions[start:end], worker_symbol_table)
+
+
+def encode_instructions(instructions, symbol_table, clean=None):
+    """Generator of the binary encoding of each clean instruction, allocating variables in symbol_table
+    If clean is given, it is called to turn each item of instructions into a clean instruction"""
+    n = 16
+    # a symbol never changes value once it is defined, so an instruction always encodes the same way
+    encoded = {}
+
+    for key in instructions:
+        binary_instruction = encoded.get(key)
+        if binary_instruction is not None:
+            yield binary_instruction
+            continue
+
+        instruction = clean(key) if clean else key
+        # Check whether the instruction is an A command or C command
+        if instruction.startswith("@"):  # Handle A command
+            value = instruction[1:]
+            if value in symbol_table:
+                binary_instruction = code_a_command(symbol_table[value])
+
+            # Handle the non symbol case
+            elif not is_symbol(value):
+                binary_instruction = code_a_command(int(value))
+
+            else:  # Handle new variable
+                symbol_table[value] = n
+                binary_instruction = code_a_command(n)
+                n += 1
+
+        else:  # Handle C command
+            binary_instruction = C_INSTRUCTIONS.get(instruction)
+            if binary_instruction is None:
+                dest, comp, jump = parser(instruction)
+                binary_instruction = code_c_command(dest, comp, jump)
+
+        encoded[key] = binary_instruction
+        yield binary_instruction
+
+
+def is_symbol(string):
+    try:
+        int(string)
+        return False
+    except ValueError:
+        return True
+
+
+def parser(c_instruction):
+    """Given a c instruction, returns the dest, comp, and jump components. Comp will not be None"""
+    c_instruction = "".join(c_instruction.split())
+    dest, _, comp = c_instruction.rpartition("=")
+    comp, _, jump = comp.partition(";")
+    return dest or None, comp, jump or None
+
+
+def code_a_command(value: int):
+    if not 0 <= value < 32768:
+        raise Exception("A-command memory address out of range. Tried @" + str(value))
+    return format(value, "016b")
+
+
+def code_c_command(dest, comp, jump):
+    """comp may not be None, but dest and/or jump may"""
+    try:
+        return "111" + COMP[comp] + DEST[dest or ""] + JUMP[jump or ""]
+    except KeyError:
+        raise Exception(f"Invalid C-command: dest={dest} comp={comp} jump={jump}")
+
+
+if __name__ == '__main__':
+    main()
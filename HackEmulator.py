@@ -0,0 +1,1111 @@
+"""Headless emulator for the hack computer: runs .asm, .hack or .bin (see HackAssembler --bin) programs"""
+import argparse
+import hashlib
+import mmap
+import os
+import select
+import re
+import struct
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    # only LockstepEmulator needs numpy
+    numpy = None
+
+from HackAssembler import COMP, ST, assemble, first_pass, load_index, load_rom, new_index
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+SCREEN = ST["SCREEN"]
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+SCREEN_ROW_WORDS = SCREEN_WIDTH // 16
+SCREEN_WORDS = SCREEN_ROW_WORDS * SCREEN_HEIGHT
+# byte -> byte with its bits in reverse order, and with its bits inverted, for use with bytes.translate
+REVERSED_BITS = bytes(int(format(byte, "08b")[::-1], 2) for byte in range(256))
+INVERTED_BITS = bytes(255 - byte for byte in range(256))
+KBD = ST["KBD"]
+# the VM stack runs from 256 up to the heap at 2048
+STACK_END = 2048
+# snapshot file header: magic, pc, a, d, cycles, halted, sha256 of the ROM, padded so RAM starts 64 bytes in
+SNAPSHOT_HEADER = struct.Struct("<4sHhhQ?32s13x")
+SNAPSHOT_MAGIC = b"HKSS"
+# names of the hack keyboard codes that are not printable characters, for input traces
+KEYS = {"space": 32, "newline": 128, "backspace": 129, "left": 130, "up": 131, "right": 132, "down": 133,
+        "home": 134, "end": 135, "pageup": 136, "pagedown": 137, "insert": 138, "delete": 139, "esc": 140,
+        **{f"f{n}": 140 + n for n in range(1, 13)}}
+KEY_NAMES = {code: name for name, code in KEYS.items()}
+# terminal escape sequences and control characters -> hack keyboard codes, for recording input
+TERMINAL_KEYS = {"\x1b[A": KEYS["up"], "\x1b[B": KEYS["down"], "\x1b[C": KEYS["right"], "\x1b[D": KEYS["left"],
+                 "\x1b[H": KEYS["home"], "\x1b[F": KEYS["end"], "\x1b[5~": KEYS["pageup"],
+                 "\x1b[6~": KEYS["pagedown"], "\x1b[2~": KEYS["insert"], "\x1b[3~": KEYS["delete"],
+                 "\x1b": KEYS["esc"], "\r": KEYS["newline"], "\n": KEYS["newline"], "\x7f": KEYS["backspace"]}
+
+
+def comp_source(comp):
+    """:returns a python expression computing the comp mnemonic from a, d and ram, wrapped to a signed 16-bit int"""
+    expression = comp.replace("M", "ram[a]").replace("A", "a").replace("D", "d").replace("!", "~")
+    if "+" in comp or "-" in comp:
+        expression = f"(({expression}) + 32768 & 0xFFFF) - 32768"
+    return expression
+
+
+def alu(comp_bits):
+    """:returns function(x, y) following the hack ALU for comp bits that have no mnemonic in COMP, where x is D and
+    y is A, or M if the a-bit (comp_bits >> 6) is set"""
+    zx, nx, zy, ny, f, no = [(comp_bits >> shift) & 1 for shift in range(5, -1, -1)]
+
+    def compute(x, y):
+        if zx:
+            x = 0
+        if nx:
+            x = ~x
+        if zy:
+            y = 0
+        if ny:
+            y = ~y
+        out = x + y if f else x & y
+        if no:
+            out = ~out
+        return (out + 32768 & 0xFFFF) - 32768
+    return compute
+
+
+def alu_source(comp_bits):
+    """:returns the python expression calling alu_<comp_bits>, the alu function for comp bits not in COMP"""
+    return f"alu_{comp_bits}(d, {'ram[a]' if comp_bits >> 6 else 'a'})"
+
+
+# 7 comp bits (a-bit first) -> (mnemonic, function(a, d, ram) returning the signed 16-bit result)
+COMPUTE = {}
+for _comp, _bits in COMP.items():
+    if int(_bits, 2) not in COMPUTE:
+        COMPUTE[int(_bits, 2)] = (_comp, eval(f"lambda a, d, ram: {comp_source(_comp)}"))
+
+# 3 jump bits -> whether the jump is taken when the result is (negative, zero, positive)
+JUMPS = {bits: (bool(bits & 4), bool(bits & 2), bool(bits & 1)) for bits in range(1, 8)}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Runs a hack program without a GUI")
+    arg_parser.add_argument("program", metavar="Xxx.(asm|hack|bin)")
+    arg_parser.add_argument("--cycles", type=int, metavar="N", help="stop after N instructions")
+    arg_parser.add_argument("--until-halt", action="store_true",
+                            help="stop once the program reaches an (END) @END 0;JMP style infinite loop")
+    arg_parser.add_argument("--engine", choices=["interpreter", "blocks"], default="interpreter",
+                            help="single-step instructions, or run compiled basic blocks (see BlockEmulator)")
+    arg_parser.add_argument("--ram", nargs="+", default=[], metavar="ADDRESS=VALUE",
+                            help="set RAM before running, such as R0=6 or 100=-1")
+    arg_parser.add_argument("--print", nargs="+", default=[], metavar="ADDRESS", dest="print_addresses",
+                            help="print these RAM addresses after running, such as R2")
+    arg_parser.add_argument("--machines", type=int, metavar="N",
+                            help="run N machines in lockstep with numpy (see LockstepEmulator); --cycles then "
+                                 "caps the instructions of each machine")
+    arg_parser.add_argument("--check", action="store_true",
+                            help="with --machines, run each machine again on its own interpreter and report any that "
+                                 "ended differently")
+    arg_parser.add_argument("--vary", nargs="+", default=[], metavar="ADDRESS=START",
+                            help="with --machines, set RAM[ADDRESS] to START + i in machine i, such as a random seed")
+    arg_parser.add_argument("--frames", metavar="DIR",
+                            help="every --frame-cycles instructions, export the screen to DIR if it changed")
+    arg_parser.add_argument("--frame-cycles", type=int, default=100000, metavar="N",
+                            help="instructions per frame for --frames (default 100000)")
+    arg_parser.add_argument("--frame-format", choices=["pbm", "png", "diff"], default="pbm",
+                            help="one image per changed frame, or only the changed words of every frame appended "
+                                 "to DIR/frames.diff (see write_frame_diff)")
+    arg_parser.add_argument("--input", metavar="TRACE",
+                            help="replay the keyboard input trace TRACE (see load_input); without --cycles, run for "
+                                 "the cycle count the trace ends with")
+    arg_parser.add_argument("--record", metavar="TRACE",
+                            help="play the program from the terminal, running --fps frames of --frame-cycles "
+                                 "instructions per second, and write the keys pressed to TRACE")
+    arg_parser.add_argument("--fps", type=int, default=30, help="frames per second for --record (default 30)")
+    arg_parser.add_argument("--hold", type=int, metavar="N",
+                            help="with --record, instructions a key stays pressed for (default --frame-cycles)")
+    arg_parser.add_argument("--profile", metavar="FOLDED",
+                            help="with --engine blocks, print the cycles spent in each VM function and write "
+                                 "the cycles of each call stack to FOLDED in the collapsed format of flamegraph.pl; "
+                                 "labels come from the .asm, or the Xxx.index.json of HackAssembler --index")
+    arg_parser.add_argument("--restore", metavar="SNAPSHOT",
+                            help="start from a snapshot written by --save for the same program (before --ram)")
+    arg_parser.add_argument("--save", metavar="SNAPSHOT", help="write the state of the machine to SNAPSHOT after running")
+    arg_parser.add_argument("--intrinsics", action="store_true",
+                            help="with --engine blocks, run routines find_intrinsics recognizes (such as Math.multiply "
+                                 "and Math.divide) natively, each call counting as one instruction; the first few "
+                                 "distinct inputs of each also run in software, and an intrinsic that does not leave "
+                                 "the same RAM falls back to its software routine")
+    arg_parser.add_argument("--intrinsic-cycles", action="store_true",
+                            help="with --intrinsics, count the instructions the software routines would have run "
+                                 "instead (measured by running them once for each distinct input, which also checks "
+                                 "every input)")
+    args = arg_parser.parse_args()
+    end = None
+    if args.input:
+        events, end = load_input(args.input, args.frame_cycles)
+        if args.cycles is None:
+            args.cycles = end
+    if args.record and (args.input or args.frames):
+        arg_parser.error("--record can not be combined with --input or --frames")
+    if args.cycles is None and not args.until_halt:
+        arg_parser.error("give --cycles N and/or --until-halt")
+    if args.machines is not None and args.engine != "interpreter":
+        arg_parser.error("--machines has its own engine")
+    if args.check and (args.machines is None or (args.cycles is None and not args.until_halt)):
+        arg_parser.error("--check needs --machines and --cycles or --until-halt")
+    if args.vary and args.machines is None:
+        arg_parser.error("--vary needs --machines")
+    if (args.frames or args.input or args.record) and args.machines is not None:
+        arg_parser.error("--frames, --input and --record are not supported with --machines")
+    if (args.restore or args.save) and args.machines is not None:
+        arg_parser.error("--restore and --save are not supported with --machines")
+    if args.profile and args.engine != "blocks":
+        arg_parser.error("--profile needs --engine blocks, which counts the instructions that run")
+    if args.intrinsics and args.engine != "blocks":
+        arg_parser.error("--intrinsics needs --engine blocks")
+    if args.intrinsic_cycles and not args.intrinsics:
+        arg_parser.error("--intrinsic-cycles needs --intrinsics")
+
+    if args.machines is not None:
+        emulator = LockstepEmulator(load_program(args.program), args.machines)
+        # RAM columns hold an address across every machine
+        ram = emulator.ram.T
+    else:
+        emulator = ENGINES[args.engine](load_program(args.program))
+        if args.restore:
+            emulator.restore(args.restore)
+        labels = load_labels(args.program) if args.intrinsics or args.profile else []
+        if args.intrinsics:
+            emulator.enable_intrinsics(labels, args.intrinsic_cycles)
+        if args.profile:
+            emulator.enable_call_stacks(labels)
+        ram = emulator.ram
+    for assignment in args.ram:
+        address, value = assignment.split("=")
+        ram[parse_address(address)] = int(value)
+    for assignment in args.vary:
+        address, start = assignment.split("=")
+        ram[parse_address(address)] = numpy.arange(int(start), int(start) + args.machines)
+    initial_ram = emulator.ram.copy() if args.check else None
+
+    events = deque(events if args.input else [])
+    start = time.perf_counter()
+    if args.record:
+        executed = record_input(emulator, args.cycles, args.until_halt, args.frame_cycles, args.fps,
+                                args.hold or args.frame_cycles, args.record)
+        print(f"{executed} instructions recorded to {args.record}")
+    elif args.frames:
+        executed, frames, exported = run_frames(emulator, args.cycles, args.until_halt, args.frame_cycles,
+                                                args.frames, args.frame_format, events)
+        print(f"{frames} frames, {exported} with screen changes exported to {args.frames}")
+    elif args.machines is not None:
+        # machines halt one by one, and keyboard events are not supported with them
+        executed = emulator.run(args.cycles, args.until_halt)
+    else:
+        executed = run_input(emulator, args.cycles, args.until_halt, events)
+    seconds = time.perf_counter() - start
+    if end is not None and emulator.cycles != end:
+        print(f"warning: {args.input} was recorded over {end} instructions, but this run took {emulator.cycles}",
+              file=sys.stderr)
+
+    if args.intrinsics:
+        print(f"{emulator.intrinsic_calls} intrinsic calls")
+    if args.save:
+        emulator.save(args.save)
+    if args.profile:
+        print_profile(profile(emulator.rom, emulator.instruction_counts(), labels))
+        with open(args.profile, "w") as folded:
+            for stack, cycles in emulator.call_stacks.items():
+                folded.write(f"{stack} {cycles}\n")
+
+    for address in args.print_addresses:
+        value = ram[parse_address(address)]
+        print(f"RAM[{address}] = {value.tolist() if args.machines is not None else value}")
+    if args.check:
+        mismatched = emulator.check(initial_ram, args.cycles, args.until_halt)
+        print(f"check: machines {mismatched} ended differently on their own" if mismatched else
+              f"check: all {args.machines} machines ended as they do on their own")
+    halted = emulator.halted.all() if args.machines is not None else emulator.halted
+    print(f"{executed} instructions in {seconds:.3f}s, {executed / seconds:,.0f} instructions per second"
+          + (" (halted)" if halted else ""))
+
+
+def run_frames(emulator, cycles, until_halt, frame_cycles, frames_dir, frame_format, events=()):
+    """Runs emulator frame_cycles instructions at a time (as run_input would run it otherwise), exporting the
+    frames in which the screen changed to frames_dir, and :returns (instructions executed, frames, frames exported)"""
+    os.makedirs(frames_dir, exist_ok=True)
+    recorder = ScreenRecorder(emulator.ram)
+    executed = 0
+    exported = 0
+    diff = open(os.path.join(frames_dir, "frames.diff"), "wb") if frame_format == "diff" else None
+    try:
+        while (cycles is None or executed < cycles) and not emulator.halted:
+            executed += run_input(emulator, frame_cycles if cycles is None else min(frame_cycles, cycles - executed),
+                                  until_halt, events)
+            screen, runs = recorder.capture(emulator.ram)
+            if diff is not None:
+                write_frame_diff(diff, recorder.frames, emulator.cycles, screen, runs)
+            elif runs:
+                image_file = os.path.join(frames_dir, f"frame_{recorder.frames:06d}.{frame_format}")
+                (write_pbm if frame_format == "pbm" else write_png)(image_file, screen)
+            exported += bool(runs)
+    finally:
+        if diff is not None:
+            diff.close()
+    return executed, recorder.frames, exported
+
+
+def run_input(emulator, cycles, until_halt, events):
+    """Runs emulator like Emulator.run, but first sets KBD to the key of each (cycle, key) event in the deque events
+    once emulator.cycles reaches its cycle, removing the events that were applied, and :returns instructions executed"""
+    executed = 0
+    while (cycles is None or executed < cycles) and not emulator.halted:
+        budget = None if cycles is None else cycles - executed
+        if events:
+            if events[0][0] <= emulator.cycles:
+                emulator.ram[KBD] = events.popleft()[1]
+                continue
+            budget = min(budget, events[0][0] - emulator.cycles) if budget is not None \
+                else events[0][0] - emulator.cycles
+        executed += emulator.run(budget, until_halt)
+    return executed
+
+
+def parse_address(address):
+    return ST[address] if address in ST else int(address)
+
+
+def load_program(program_file):
+    """:returns list of the 16-bit instruction words of a .asm, .hack or .bin program"""
+    if program_file.endswith(".bin"):
+        return list(load_rom(program_file))
+    with open(program_file, "r") as program:
+        if program_file.endswith(".asm"):
+            return [int(binary_instruction, 2) for binary_instruction in assemble(program)]
+        return [int(line, 2) for line in program if line.strip()]
+
+
+def load_labels(program_file):
+    """:returns list of (ROM address, label) in address order for a .asm program, or for a .hack or .bin program
+    that HackAssembler --index wrote an Xxx.index.json for (otherwise an empty list)"""
+    if program_file.endswith(".asm"):
+        index = new_index()
+        with open(program_file, "r") as program:
+            first_pass(program, dict(ST), index)
+    else:
+        index_file = program_file.rsplit(".", 1)[0] + ".index.json"
+        if not os.path.exists(index_file):
+            return []
+        index = load_index(index_file)
+    return list(zip(index["label_addresses"], index["label_names"]))
+
+
+def to_int16(value):
+    return (value + 32768) % 65536 - 32768
+
+
+def jack_divide(x, y):
+    """:returns x / y rounded toward zero as the Jack OS specifies, or None where implementations differ (dividing
+    by zero is a Sys.error, and -32768 has no positive counterpart)"""
+    if y == 0 or x == -32768 or y == -32768:
+        return None
+    quotient = abs(x) // abs(y)
+    return quotient if (x < 0) == (y < 0) else -quotient
+
+
+# how many distinct inputs of each intrinsic BlockEmulator checks against the software routine
+CHECKED_INPUTS = 8
+# VM functions BlockEmulator can run natively (see vm_intrinsic): entry label -> function(x, y) of the two arguments
+# returning the result, or None to run the software version
+VM_INTRINSICS = {
+    "Math.multiply": lambda x, y: to_int16(x * y),
+    "Math.divide": jack_divide,
+}
+# the start of the VMTranslator.get_return sequence, which is followed by @retAddr
+RETURN_START = [int(word, 2) for word in assemble(["@LCL", "D=M", "@5", "A=D-A", "D=M"])]
+
+
+def find_intrinsics(rom, labels):
+    """:returns {entry address: intrinsic} for the routines in rom that can run natively: the VM_INTRINSICS functions
+    by entry label, and the ROUTINE_INTRINSICS by the sha256 of their code. An intrinsic is a function(a, d, ram)
+    called with the state at the entry address that does not change anything, and :returns None if the software
+    routine has to run, or (input key, a, d, pc, list of (address, value) RAM writes) where a, d and pc are the
+    state the software routine would finish in, and the writes leave RAM as the software would, except that a VM
+    function's locals and working stack above the SP it returns with are left as they were"""
+    intrinsics = {}
+    for start, end, entry, fingerprint, intrinsic in ROUTINE_INTRINSICS:
+        if hashlib.sha256(little_endian_bytes(array("H", rom[start:end]))).hexdigest() == fingerprint:
+            intrinsics[entry] = intrinsic
+
+    for address in range(len(rom) - len(RETURN_START)):
+        if rom[address:address + len(RETURN_START)] == RETURN_START:
+            ret_addr = rom[address + len(RETURN_START)]
+            break
+    else:
+        # not a VMTranslator program
+        return intrinsics
+    for address, label in labels:
+        if label in VM_INTRINSICS:
+            intrinsics[address] = vm_intrinsic(VM_INTRINSICS[label], ret_addr)
+    return intrinsics
+
+
+def vm_intrinsic(operation, ret_addr):
+    """:returns an intrinsic for a VM function of two arguments, given where the retAddr variable is. It performs
+    the VMTranslator.get_return sequence as the function would at its end, except for the locals and working stack
+    of the function, which are above SP after returning, so no VM code can see them"""
+    def intrinsic(a, d, ram):
+        frame, arg = ram[ST["LCL"]], ram[ST["ARG"]]
+        x, y = ram[arg], ram[arg + 1]
+        result = operation(x, y)
+        if result is None:
+            return None
+        return_address = ram[frame - 5]
+        writes = [(ret_addr, return_address), (arg, result), (ST["SP"], arg + 1), (ST["THAT"], ram[frame - 1]),
+                  (ST["THIS"], ram[frame - 2]), (ST["ARG"], ram[frame - 3]), (ST["LCL"], ram[frame - 4])]
+        return (x, y), return_address, ram[frame - 4], return_address & 0x7FFF, writes
+    return intrinsic
+
+
+def shift_add_multiply(a, d, ram):
+    """Intrinsic for the (Main) loop of AssemblyCodes/Mult.asm, which adds n << i to sum for each bit i of m that is
+    set, from i up to 16, using the variables sum, n, m, i, mask and bit at 16 to 21 and R4 as a return address"""
+    total, n, m, i = ram[16], ram[17], ram[18], ram[19]
+    if not 0 <= i <= 16:
+        return None
+    writes = []
+    if i < 16:
+        mask = 0
+        for bit in range(i, 16):
+            mask = to_int16(1 << bit)
+            if m & mask:
+                total = to_int16(total + n)
+            n = to_int16(n + n)
+        # R4 = (Return_from_add), and the mask loop counts bit down to 0
+        writes = [(16, total), (17, n), (19, 16), (20, mask), (21, 0), (4, 67)]
+    # the loop ends at @End D;JEQ with D = i - 16
+    return (ram[17], m, i), 74, 0, 74, writes
+
+
+# hack routines BlockEmulator can run natively: (first address, end address, entry address, sha256 of the
+# little-endian words from first to end address, intrinsic). Their code has absolute addresses in it, so a routine
+# is only recognized where its program put it
+ROUTINE_INTRINSICS = [
+    (18, 74, 43, "a1d91b9e25c66d3d230b96bb7f249ea3f4b55df1542782e288cdcc85195a1e11", shift_add_multiply),
+]
+
+
+def rom_hash(rom):
+    """:returns the sha256 digest of the ROM words as little-endian uint16"""
+    return hashlib.sha256(little_endian_bytes(array("H", rom))).digest()
+
+
+def decode(word):
+    """:returns the compact form of an instruction word: the int value of an A command, or for a C command a tuple
+    (compute, dest A, dest D, dest M, jump) where compute is a function(a, d, ram) and jump is None or a JUMPS entry"""
+    if word < 32768:
+        return word
+    comp_bits = (word >> 6) & 0x7F
+    if comp_bits in COMPUTE:
+        compute = COMPUTE[comp_bits][1]
+    else:
+        compute = eval(f"lambda a, d, ram: {alu_source(comp_bits)}", {f"alu_{comp_bits}": alu(comp_bits)})
+    return compute, bool(word & 0x20), bool(word & 0x10), bool(word & 0x8), JUMPS.get(word & 0x7)
+
+
+def find_halts(rom):
+    """:returns the set of addresses of jumps that leave the program stuck for good, such as the 0;JMP of the
+    (END) @END 0;JMP loop hack programs end with: an unconditional @k jump back to k with no other jump since k"""
+    halts = set()
+    # the address of the latest jump instruction seen so far
+    last_jump = -1
+    for address, word in enumerate(rom):
+        if word >= 32768 and word & 0x7:
+            target = rom[address - 1] if address > 0 else 32768
+            if word & 0x7 == 0x7 and target < 32768 and last_jump < target < address:
+                halts.add(address)
+            last_jump = address
+    return halts
+
+
+class Emulator:
+    """Runs hack machine code. Instructions are decoded once up front, and RAM is an array('h'), so RAM values are
+    signed 16-bit ints. RAM and ROM both have 32K words, so negative addresses index them like 15-bit addresses"""
+
+    def __init__(self, rom):
+        if len(rom) > ROM_SIZE:
+            raise Exception(f"Program has {len(rom)} instructions, but ROM only holds {ROM_SIZE}")
+        self.rom = list(rom) + [0] * (ROM_SIZE - len(rom))
+        self.program = [decode(word) for word in self.rom]
+        self.halts = find_halts(self.rom)
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def save(self, snapshot_file):
+        """Writes the registers, RAM and a hash of the ROM to snapshot_file (see SNAPSHOT_HEADER), RAM as
+        little-endian int16 words, so restore can map it back in as is"""
+        with open(snapshot_file, "wb") as snapshot:
+            snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.pc, self.a, self.d, self.cycles, self.halted,
+                                                rom_hash(self.rom)))
+            snapshot.write(little_endian_bytes(self.ram))
+
+    def restore(self, snapshot_file):
+        """Loads a snapshot written by save for the same ROM. RAM is memory-mapped copy-on-write rather than read,
+        so restoring is instant and processes restoring (or forked after restoring) the same snapshot share its
+        pages until they write to them"""
+        with open(snapshot_file, "rb") as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(mapped) != SNAPSHOT_HEADER.size + 2 * RAM_SIZE:
+            raise Exception(f"{snapshot_file} is not an emulator snapshot")
+        magic, pc, a, d, cycles, halted, snapshot_rom = SNAPSHOT_HEADER.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception(f"{snapshot_file} is not an emulator snapshot")
+        if snapshot_rom != rom_hash(self.rom):
+            raise Exception(f"{snapshot_file} was saved while running a different program")
+        ram = memoryview(mapped)[SNAPSHOT_HEADER.size:].cast("h")
+        if sys.byteorder == "big":
+            ram = array("h", ram)
+            ram.byteswap()
+        self.ram = ram
+        self.pc, self.a, self.d, self.cycles, self.halted = pc, a, d, cycles, halted
+
+    def run(self, cycles=None, until_halt=False):
+        """Executes up to cycles instructions (forever if None), stopping early at a halt loop if until_halt,
+        and :returns the number of instructions executed"""
+        program = self.program
+        ram = self.ram
+        halts = self.halts if until_halt else ()
+        a, d, pc = self.a, self.d, self.pc
+        remaining = cycles if cycles is not None else float("inf")
+        executed = 0
+
+        while executed < remaining:
+            if pc == ROM_SIZE:
+                raise Exception("Ran past the end of ROM")
+            instruction = program[pc]
+            executed += 1
+            if instruction.__class__ is int:
+                a = instruction
+                pc += 1
+                continue
+
+            compute, dest_a, dest_d, dest_m, jump = instruction
+            value = compute(a, d, ram)
+            address = a
+            if dest_m:
+                ram[a] = value
+            if dest_a:
+                a = value
+            if dest_d:
+                d = value
+            # jumps go to the value A had before this instruction, as in the hack CPU
+            if jump and jump[(value >= 0) + (value > 0)]:
+                if pc in halts:
+                    self.halted = True
+                    pc = address & 0x7FFF
+                    break
+                pc = address & 0x7FFF
+            else:
+                pc += 1
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        return executed
+
+
+class BlockEmulator(Emulator):
+    """Runs hack machine code a basic block at a time: the straight-line instructions from an entry address up to and
+    including the next jump are compiled into one python function, which is cached by entry address. Blocks are
+    compiled the first time execution enters them, so jumps to computed addresses (such as VM return addresses)
+    simply start new blocks. Runs that must stop inside a block (--cycles) finish on the interpreter"""
+
+    def __init__(self, rom):
+        super().__init__(rom)
+        # entry address -> (function(a, d, ram) returning (a, d, pc), instructions in the block, ends in a halt jump)
+        # or None if execution has not entered at that address yet
+        self.blocks = [None] * ROM_SIZE
+        # times execution entered each block, and times each address ran when finishing a run on the interpreter
+        # (plus the cycles of intrinsic calls at their entry), from which instruction_counts works out how often
+        # every address ran
+        self.entries = array("q", bytes(8 * ROM_SIZE))
+        self.partial = array("q", bytes(8 * ROM_SIZE))
+        # entry address -> intrinsic function (see find_intrinsics), and the software blocks at those addresses
+        self.intrinsics = {}
+        self.software_blocks = {}
+        self.intrinsic_calls = 0
+        # the software routine of an intrinsic runs on a scratch interpreter for its first CHECKED_INPUTS distinct
+        # inputs (counted in checked_inputs), to check the intrinsic against it. With account_intrinsics, it runs for
+        # every distinct input, and intrinsic calls count the instructions it took. These are kept in intrinsic_cycles
+        # by (entry address, input)
+        self.account_intrinsics = False
+        self.checked_inputs = {}
+        self.intrinsic_cycles = {}
+        self.scratch = None
+        # with enable_call_stacks, "(init);Caller;Callee" style call stack -> cycles run in it
+        self.call_stacks = None
+
+    def enable_intrinsics(self, labels, account=False):
+        """Runs the routines find_intrinsics recognizes natively from now on"""
+        self.intrinsics = find_intrinsics(self.rom, labels)
+        self.account_intrinsics = account
+        for entry in self.intrinsics:
+            # a block of length 0 marks an intrinsic for run
+            self.blocks[entry] = (None, 0, False)
+
+    def enable_call_stacks(self, labels):
+        """Counts the cycles run in each call stack of a VMTranslator program in call_stacks from now on, given its
+        labels (see load_labels). Stacks follow the call/return protocol as blocks are entered: entering a function
+        pushes it along with its return address (RAM[LCL - 5]), and entering a return address pops back to the call
+        that it returns from. Code in the SHARED_ROUTINES is counted as a leaf of the stack that jumped to it"""
+        self.call_stacks = {}
+        self.function_entries = {address: label for address, label in labels
+                                 if is_function_label(label) and label not in SHARED_ROUTINES}
+        self.return_addresses = {address for address, label in labels if "$ret." in label}
+        # start address of each function and shared routine, and the shared routine's name or None for a function
+        owners = sorted((address, label if label in SHARED_ROUTINES else None) for address, label in labels
+                        if is_function_label(label))
+        self.owner_starts = [0] + [address for address, _ in owners]
+        self.owner_routines = [None] + [routine for _, routine in owners]
+        # (function, return address, stack up to and including it)
+        self.call_stack = [("(init)", None, "(init)")]
+
+    def enter_block(self, pc):
+        """Follows the VM call/return protocol into the block at pc and :returns the call stack the block runs in"""
+        call_stack = self.call_stack
+        if pc in self.return_addresses:
+            for depth in range(len(call_stack) - 1, 0, -1):
+                if call_stack[depth][1] == pc:
+                    del call_stack[depth:]
+                    break
+        name = self.function_entries.get(pc)
+        if name is not None:
+            return_address = self.ram[self.ram[ST["LCL"]] - 5]
+            call_stack.append((name, return_address, f"{call_stack[-1][2]};{name}"))
+        routine = self.owner_routines[bisect_right(self.owner_starts, pc) - 1]
+        return call_stack[-1][2] if routine is None else f"{call_stack[-1][2]};{routine}"
+
+    def run(self, cycles=None, until_halt=False):
+        blocks = self.blocks
+        entries = self.entries
+        ram = self.ram
+        call_stacks = self.call_stacks
+        a, d, pc = self.a, self.d, self.pc
+        remaining = cycles if cycles is not None else float("inf")
+        executed = 0
+
+        while executed < remaining:
+            if pc == ROM_SIZE:
+                raise Exception("Ran past the end of ROM")
+            if call_stacks is not None:
+                stack = self.enter_block(pc)
+            block = blocks[pc]
+            if block is None:
+                block = blocks[pc] = self.compile_block(pc)
+            function, length, halts = block
+            if not length:
+                result = self.run_intrinsic(a, d, pc, remaining - executed)
+                if result is not None:
+                    # the intrinsic's cycles count as runs of its entry address, so they add up in profiles
+                    self.partial[pc] += result[3]
+                    a, d, pc, cycles = result
+                    executed += cycles
+                    if call_stacks is not None:
+                        call_stacks[stack] = call_stacks.get(stack, 0) + cycles
+                    continue
+                if pc not in self.software_blocks:
+                    self.software_blocks[pc] = self.compile_block(pc)
+                function, length, halts = self.software_blocks[pc]
+            if executed + length > remaining:
+                # the run ends inside this block, so single-step the rest of it
+                self.a, self.d, self.pc = a, d, pc
+                self.cycles += executed
+                for address in range(pc, pc + remaining - executed):
+                    self.partial[address] += 1
+                if call_stacks is not None:
+                    call_stacks[stack] = call_stacks.get(stack, 0) + remaining - executed
+                return executed + super().run(remaining - executed, until_halt)
+            entries[pc] += 1
+            a, d, pc = function(a, d, ram)
+            executed += length
+            if call_stacks is not None:
+                call_stacks[stack] = call_stacks.get(stack, 0) + length
+            if halts and until_halt:
+                self.halted = True
+                break
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        return executed
+
+    def instruction_counts(self):
+        """:returns array of the number of times each ROM address has run"""
+        counts = array("q", self.partial)
+        for entry, count in enumerate(self.entries):
+            if count:
+                for address in range(entry, entry + self.software_blocks.get(entry, self.blocks[entry])[1]):
+                    counts[address] += count
+        return counts
+
+    def run_intrinsic(self, a, d, pc, budget):
+        """Runs the intrinsic at pc on the current RAM and :returns (a, d, pc, instructions counted), or None if the
+        software routine has to run instead (the intrinsic does not handle the input, or with account_intrinsics,
+        the routine would not finish within budget instructions)"""
+        effect = self.intrinsics[pc](a, d, self.ram)
+        if effect is None:
+            return None
+        key, a_after, d_after, pc_after, writes = effect
+        cycles = 1
+        checked = self.checked_inputs.get(pc, 0)
+        if (checked < CHECKED_INPUTS or self.account_intrinsics) and (pc, key) not in self.intrinsic_cycles:
+            measured = self.measure_routine(a, d, pc, effect)
+            if measured is None:
+                # the software routine does more than the intrinsic, so it runs from now on
+                del self.intrinsics[pc]
+                self.blocks[pc] = None
+                print(f"warning: the intrinsic at {pc} does not match its software routine for input {key}, "
+                      f"so the software routine runs instead", file=sys.stderr)
+                return None
+            self.intrinsic_cycles[pc, key] = measured
+            self.checked_inputs[pc] = checked + 1
+        if self.account_intrinsics:
+            cycles = self.intrinsic_cycles[pc, key]
+            if cycles > budget:
+                return None
+        for address, value in writes:
+            self.ram[address] = value
+        self.intrinsic_calls += 1
+        return a_after, d_after, pc_after, cycles
+
+    def measure_routine(self, a, d, pc, effect):
+        """:returns the number of instructions the software routine at pc runs from the current state, or None if it
+        does not end in the same registers and RAM as the intrinsic's effect leaves. For an intrinsic that sets SP,
+        the RAM from the new SP up to STACK_END is not compared, as it only held the routine's locals and stack"""
+        if self.scratch is None:
+            self.scratch = Emulator(self.rom)
+        scratch = self.scratch
+        scratch.ram = array("h", self.ram)
+        scratch.a, scratch.d, scratch.pc = a, d, pc
+        key, a_after, d_after, pc_after, writes = effect
+        executed = 0
+        while scratch.pc != pc_after:
+            executed += scratch.run(1)
+            if executed > 10 ** 7:
+                raise Exception(f"The routine at {pc} did not return to {pc_after} within {executed} instructions")
+        expected = array("h", self.ram)
+        for address, value in writes:
+            expected[address] = value
+        compared_end = RAM_SIZE
+        if any(address == ST["SP"] for address, _ in writes):
+            compared_end = expected[ST["SP"]]
+        if (scratch.a, scratch.d) != (a_after, d_after) or scratch.ram[:compared_end] != expected[:compared_end] or \
+                scratch.ram[max(compared_end, STACK_END):] != expected[max(compared_end, STACK_END):]:
+            return None
+        return executed
+
+    def compile_block(self, entry):
+        """:returns (function, length, ends in a halt jump) for the basic block starting at entry"""
+        lines = ["def block(a, d, ram):"]
+        namespace = {}
+        # the value of A while it is a constant known at compile time, so it can be used as a literal
+        known_a = None
+        address = entry
+        jumped = False
+
+        while address < ROM_SIZE and not jumped:
+            word = self.rom[address]
+            address += 1
+            if word < 32768:
+                known_a = word
+                continue
+
+            comp_bits = (word >> 6) & 0x7F
+            if comp_bits in COMPUTE:
+                expression = comp_source(COMPUTE[comp_bits][0])
+            else:
+                namespace[f"alu_{comp_bits}"] = alu(comp_bits)
+                expression = alu_source(comp_bits)
+            if known_a is not None:
+                expression = re.sub(r"\ba\b", str(known_a), expression)
+            dest_a, dest_d, dest_m, jump = word & 0x20, word & 0x10, word & 0x8, word & 0x7
+
+            a_now = "a" if known_a is None else str(known_a)
+            if jump:
+                jumped = True
+                lines.append(f"    target = {a_now} & 0x7FFF")
+            if not (dest_a or dest_d or dest_m or jump):
+                continue
+            lines.append(f"    value = {expression}")
+            if dest_m:
+                lines.append(f"    ram[{a_now}] = value")
+            if dest_a:
+                lines.append("    a = value")
+                known_a = None
+            if dest_d:
+                lines.append("    d = value")
+
+        a_now = "a" if known_a is None else str(known_a)
+        if jumped:
+            condition = {1: "value > 0", 2: "value == 0", 3: "value >= 0", 4: "value < 0", 5: "value != 0",
+                         6: "value <= 0", 7: "True"}[jump]
+            lines.append(f"    if {condition}:")
+            lines.append(f"        return {a_now}, d, target")
+        lines.append(f"    return {a_now}, d, {address}")
+
+        exec(compile("\n".join(lines), f"<block {entry}>", "exec"), namespace)
+        halts = jumped and address - 1 in self.halts
+        return namespace["block"], address - entry, halts
+
+
+# how many instructions LockstepEmulator lets a machine fall behind the others before running it first
+MAX_LAG = 1000
+
+
+class LockstepEmulator:
+    """Runs n copies of one program in lockstep, holding their registers as numpy arrays and their RAM as an
+    (n, 32K) numpy array. Each step executes the instruction at the lowest PC among the running machines, for every
+    machine at that PC at once; machines whose branches went elsewhere are masked out until the others catch up.
+    A machine more than MAX_LAG instructions behind another runs first, so one stuck in a loop can not hold the others
+    back, and each machine ends as it would on its own Emulator"""
+
+    def __init__(self, rom, n):
+        if numpy is None:
+            raise Exception("LockstepEmulator needs numpy")
+        if len(rom) > ROM_SIZE:
+            raise Exception(f"Program has {len(rom)} instructions, but ROM only holds {ROM_SIZE}")
+        self.rom = list(rom) + [0] * (ROM_SIZE - len(rom))
+        self.halts = find_halts(self.rom)
+        self.n = n
+        self.ram = numpy.zeros((n, RAM_SIZE), dtype=numpy.int16)
+        self.a = numpy.zeros(n, dtype=numpy.int32)
+        self.d = numpy.zeros(n, dtype=numpy.int32)
+        self.pc = numpy.zeros(n, dtype=numpy.int32)
+        self.halted = numpy.zeros(n, dtype=bool)
+        # instructions executed by each machine
+        self.cycles = numpy.zeros(n, dtype=numpy.int64)
+        # address -> vectorized form of the instruction, decoded when first executed
+        self.program = {}
+        self.steps = 0
+        self.machine_cycles = 0
+
+    def decode(self, address):
+        """:returns the value of an A command, or (compute(a, d, m), reads M, dest A, dest D, dest M, jump) for a
+        C command, where compute works on numpy arrays and jump is None or a function of the result"""
+        word = self.rom[address]
+        if word < 32768:
+            return word
+        comp_bits = (word >> 6) & 0x7F
+        namespace = {"alu_" + str(comp_bits): alu(comp_bits)}
+        source = comp_source(COMPUTE[comp_bits][0]) if comp_bits in COMPUTE else alu_source(comp_bits)
+        compute = eval(f"lambda a, d, m: {source.replace('ram[a]', 'm')}", namespace)
+        jump = word & 0x7
+        condition = None
+        if jump:
+            condition = eval("lambda value: " + {1: "value > 0", 2: "value == 0", 3: "value >= 0", 4: "value < 0",
+                                                 5: "value != 0", 6: "value <= 0", 7: "True"}[jump])
+        return compute, bool(comp_bits >> 6), bool(word & 0x20), bool(word & 0x10), bool(word & 0x8), condition
+
+    def run(self, cycles=None, until_halt=False):
+        """Executes up to cycles instructions on each machine (until every machine halts if None), and :returns the
+        number of machine instructions executed, summed over the machines"""
+        ram, a_registers, d_registers, pcs, lane_cycles = self.ram, self.a, self.d, self.pc, self.cycles
+        all_lanes = numpy.arange(self.n)
+        end = lane_cycles + (cycles if cycles is not None else numpy.iinfo(numpy.int64).max // 2)
+        executed_steps = 0
+        machine_cycles = 0
+
+        while True:
+            running = ~self.halted & (lane_cycles < end)
+            if not running.any():
+                break
+            # the lowest PC keeps machines that branched apart in step best, as loops and ifs jump back up to where
+            # they meet again, unless that leaves a machine too far behind the others
+            running_cycles = lane_cycles[running]
+            if running_cycles.max() - running_cycles.min() > MAX_LAG:
+                pc = int(pcs[numpy.where(running, lane_cycles, numpy.iinfo(numpy.int64).max).argmin()])
+            else:
+                pc = int(pcs[running].min())
+            if pc == ROM_SIZE:
+                raise Exception("Ran past the end of ROM")
+            instruction = self.program.get(pc)
+            if instruction is None:
+                instruction = self.program[pc] = self.decode(pc)
+
+            lanes = numpy.flatnonzero(running & (pcs == pc))
+            if len(lanes) == self.n:
+                lanes = all_lanes
+            executed_steps += 1
+            machine_cycles += len(lanes)
+            lane_cycles[lanes] += 1
+
+            if instruction.__class__ is int:
+                a_registers[lanes] = instruction
+                pcs[lanes] = pc + 1
+                continue
+
+            compute, reads_m, dest_a, dest_d, dest_m, jump = instruction
+            a = a_registers[lanes]
+            value = compute(a, d_registers[lanes], ram[lanes, a].astype(numpy.int32) if reads_m else None)
+            value = numpy.broadcast_to(numpy.asarray(value, dtype=numpy.int32), lanes.shape)
+            if dest_m:
+                ram[lanes, a] = value
+            if dest_a:
+                a_registers[lanes] = value
+            if dest_d:
+                d_registers[lanes] = value
+            if jump is None:
+                pcs[lanes] = pc + 1
+                continue
+
+            taken = numpy.broadcast_to(jump(value), lanes.shape)
+            # jumps go to the value A had before this instruction, as in the hack CPU
+            pcs[lanes] = numpy.where(taken, a & 0x7FFF, pc + 1)
+            if until_halt and pc in self.halts:
+                self.halted[lanes[taken]] = True
+
+        self.steps += executed_steps
+        self.machine_cycles += machine_cycles
+        return machine_cycles
+
+    def check(self, initial_ram, cycles=None, until_halt=False):
+        """Runs each machine again from initial_ram (its RAM before run) on its own Emulator, and :returns the list
+        of machines that did not end in the same state (registers, RAM, instructions executed and halting)"""
+        mismatched = []
+        for lane in range(self.n):
+            emulator = Emulator(self.rom)
+            emulator.ram = array("h", initial_ram[lane].tobytes())
+            emulator.run(cycles, until_halt)
+            lockstep_state = (to_int16(int(self.a[lane])), to_int16(int(self.d[lane])), int(self.pc[lane]),
+                              int(self.cycles[lane]), bool(self.halted[lane]))
+            state = (to_int16(emulator.a), to_int16(emulator.d), emulator.pc, emulator.cycles, emulator.halted)
+            if lockstep_state != state or emulator.ram.tobytes() != self.ram[lane].tobytes():
+                mismatched.append(lane)
+        return mismatched
+
+
+class ScreenRecorder:
+    """Finds what changed in the SCREEN memory map (256 rows of 32 words, bit 0 of a word is its leftmost pixel)
+    since the last frame by comparing against a copy of it, a row at a time and then a word at a time within the
+    rows that changed, so nothing has to be tracked while the program runs"""
+
+    def __init__(self, ram):
+        self.previous = array("h", ram[SCREEN:SCREEN + SCREEN_WORDS])
+        self.frames = 0
+
+    def capture(self, ram):
+        """Starts a new frame and :returns (screen, list of (first word, last word + 1) runs of changed words)
+        where screen is an array('h') copy of the SCREEN memory map"""
+        screen = array("h", ram[SCREEN:SCREEN + SCREEN_WORDS])
+        self.frames += 1
+        if screen == self.previous:
+            return screen, []
+
+        runs = []
+        for row in range(0, SCREEN_WORDS, SCREEN_ROW_WORDS):
+            row_end = row + SCREEN_ROW_WORDS
+            if screen[row:row_end] == self.previous[row:row_end]:
+                continue
+            for word in range(row, row_end):
+                if screen[word] != self.previous[word]:
+                    if runs and runs[-1][1] == word:
+                        runs[-1][1] = word + 1
+                    else:
+                        runs.append([word, word + 1])
+        self.previous = screen
+        return screen, [tuple(run) for run in runs]
+
+
+def screen_rows(screen):
+    """:returns bytes of the screen as 256 rows of 64 bytes, with the leftmost pixel of each byte as its top bit
+    and a set bit for a black pixel, which is the bitmap layout of both PBM and 1-bit PNG"""
+    return little_endian_bytes(screen).translate(REVERSED_BITS)
+
+
+def little_endian_bytes(words):
+    """:returns the bytes of the 16-bit words (an array or memoryview) in little-endian order"""
+    if sys.byteorder == "big":
+        words = array("H", memoryview(words).cast("B").cast("H"))
+        words.byteswap()
+    return words.tobytes()
+
+
+def write_pbm(image_file, screen):
+    with open(image_file, "wb") as image:
+        image.write(f"P4\n{SCREEN_WIDTH} {SCREEN_HEIGHT}\n".encode())
+        image.write(screen_rows(screen))
+
+
+def write_png(image_file, screen):
+    """Writes the screen as a 1-bit grayscale PNG (in which a set bit is white, so the bits are inverted)"""
+    rows = screen_rows(screen).translate(INVERTED_BITS)
+    row_bytes = SCREEN_WIDTH // 8
+    # every row of PNG image data starts with its filter type, 0 for none
+    image_data = b"".join(b"\0" + rows[i:i + row_bytes] for i in range(0, len(rows), row_bytes))
+
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    with open(image_file, "wb") as image:
+        image.write(b"\x89PNG\r\n\x1a\n")
+        image.write(chunk(b"IHDR", struct.pack(">IIBBBBB", SCREEN_WIDTH, SCREEN_HEIGHT, 1, 0, 0, 0, 0)))
+        image.write(chunk(b"IDAT", zlib.compress(image_data)))
+        image.write(chunk(b"IEND", b""))
+
+
+def write_frame_diff(out, frame, cycle, screen, runs):
+    """Appends a frame to a frame-diff stream: a little-endian header of the frame number (uint32), the cycle it
+    was captured at (uint64) and the number of runs (uint16), then for each run its first word offset into SCREEN
+    and its length (uint16 each) followed by that many int16 screen words"""
+    out.write(struct.pack("<IQH", frame, cycle, len(runs)))
+    for start, end in runs:
+        out.write(struct.pack("<HH", start, end - start))
+        out.write(little_endian_bytes(screen[start:end]))
+
+
+def parse_key(key):
+    """:returns the hack keyboard code of a key name from KEYS, a single character (letters are upper case, as
+    the hack keyboard only has those) or a number"""
+    if key.lower() in KEYS:
+        return KEYS[key.lower()]
+    if len(key) == 1:
+        return ord(key.upper())
+    return int(key)
+
+
+def key_name(code):
+    if code in KEY_NAMES:
+        return KEY_NAMES[code]
+    return chr(code) if 32 < code < 127 else str(code)
+
+
+def load_input(trace_file, frame_cycles):
+    """:returns (list of (cycle, key code) events in cycle order, cycle count the trace ends at or None) from a
+    keyboard input trace. Each line of a trace is "CYCLE KEY" to set KBD to KEY (0 or release to let go of all keys)
+    once CYCLE instructions have run, "frame N KEY" for CYCLE = N * frame_cycles, or "end CYCLE" for how long the
+    recorded run was, with // comments as in hack assembly"""
+    events = []
+    end = None
+    with open(trace_file, "r") as trace:
+        for line_number, line in enumerate(trace, 1):
+            fields = line.split("//")[0].split()
+            if not fields:
+                continue
+            if fields[0] == "end" and len(fields) == 2:
+                end = int(fields[1])
+            elif fields[0] == "frame" and len(fields) == 3:
+                events.append((int(fields[1]) * frame_cycles, parse_key(fields[2])))
+            elif len(fields) == 2:
+                events.append((int(fields[0]), 0 if fields[1] == "release" else parse_key(fields[1])))
+            else:
+                raise Exception(f"Invalid input trace line {line_number} of {trace_file}: {line.strip()}")
+    # sorted is stable, so events at the same cycle keep their order
+    return sorted(events, key=lambda event: event[0]), end
+
+
+def read_terminal_key():
+    """:returns the hack keyboard code of a key waiting on the terminal (stdin in cbreak mode), or None"""
+    if not select.select([sys.stdin], [], [], 0)[0]:
+        return None
+    key = os.read(sys.stdin.fileno(), 8).decode(errors="ignore")
+    if key in TERMINAL_KEYS:
+        return TERMINAL_KEYS[key]
+    return parse_key(key[0]) if key and 32 <= ord(key[0]) < 127 else None
+
+
+def record_input(emulator, cycles, until_halt, frame_cycles, fps, hold, trace_file):
+    """Runs emulator at fps frames of frame_cycles instructions per second while reading keys from the terminal,
+    pressing each key for hold instructions (terminals do not report key releases), and writes the input trace of
+    the run to trace_file, so run_input can replay it to the same state. :returns instructions executed"""
+    import termios
+    import tty
+
+    if not sys.stdin.isatty():
+        raise Exception("--record needs a terminal to read keys from")
+    settings = termios.tcgetattr(sys.stdin)
+    executed = 0
+    release = None
+    with open(trace_file, "w") as trace:
+        trace.write(f"// keyboard input for {frame_cycles} instruction frames, see HackEmulator.load_input\n")
+        try:
+            tty.setcbreak(sys.stdin)
+            while (cycles is None or executed < cycles) and not emulator.halted:
+                frame_start = time.perf_counter()
+                budget = frame_cycles if cycles is None else min(frame_cycles, cycles - executed)
+                if release is not None:
+                    budget = min(budget, release - emulator.cycles)
+                executed += emulator.run(budget, until_halt)
+                key = read_terminal_key()
+                if key is not None:
+                    emulator.ram[KBD] = key
+                    release = emulator.cycles + hold
+                    trace.write(f"{emulator.cycles} {key_name(key)}\n")
+                elif release is not None and emulator.cycles >= release:
+                    emulator.ram[KBD] = 0
+                    release = None
+                    trace.write(f"{emulator.cycles} release\n")
+                time.sleep(max(0.0, 1 / fps - (time.perf_counter() - frame_start)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, settings)
+        trace.write(f"end {emulator.cycles}\n")
+    return executed
+
+
+# the labels of the routines VMTranslator shares between functions, which have no . so they can not clash with them
+SHARED_ROUTINES = ("VM$call", "VM$return", "VM$eq", "VM$gt", "VM$lt")
+
+
+def profile(rom, counts, labels):
+    """:returns the flat profile of a VMTranslator program given how often each ROM address ran (see
+    BlockEmulator.instruction_counts) and its labels (see load_labels): a list of (function, cycles spent in it,
+    calls) by most cycles first, where code is attributed to the last function label (see is_function_label) before
+    it, and code before the first function to (init).
+    Calls are counted at each call site: VMTranslator.get_call ends in @callee 0;JMP (Caller$ret.N), or in
+    @callee D=A @VM$call 0;JMP (Caller$ret.N) with trampolines, and the @callee runs once per call"""
+    functions = [(0, "(init)")] + [(address, label) for address, label in labels if is_function_label(label)]
+    self_cycles = {}
+    for (start, name), (end, _) in zip(functions, functions[1:] + [(len(rom), None)]):
+        self_cycles[name] = self_cycles.get(name, 0) + sum(counts[start:end])
+    function_at = {address: name for address, name in functions}
+
+    calls = {name: 0 for name in self_cycles}
+    for address, label in labels:
+        if "$ret." not in label or address < 4:
+            continue
+        callee_address = address - 2
+        if function_at.get(rom[callee_address]) == "VM$call":
+            callee_address = address - 4
+        if rom[callee_address] in function_at:
+            calls[function_at[rom[callee_address]]] += counts[callee_address]
+    return sorted(((name, cycles, calls[name]) for name, cycles in self_cycles.items() if cycles),
+                  key=lambda function: -function[1])
+
+
+def is_function_label(label):
+    """:returns whether label starts a VM function (Function.name) or one of the SHARED_ROUTINES"""
+    return ("." in label and "$" not in label) or label in SHARED_ROUTINES
+
+
+def print_profile(flat, file=sys.stdout):
+    total = sum(cycles for _, cycles, _ in flat) or 1
+    print(f"{'cycles':>12} {'%':>6} {'calls':>10} {'cycles/call':>11}  function", file=file)
+    for name, cycles, calls in flat:
+        per_call = f"{cycles / calls:,.0f}" if calls else ""
+        print(f"{cycles:>12,} {100 * cycles / total:>6.2f} {calls:>10,} {per_call:>11}  {name}", file=file)
+
+
+ENGINES = {"interpreter": Emulator, "blocks": BlockEmulator}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Peephole optimizer for hack assembly, mainly for the code VMTranslator emits.
+Assumptions: the program follows the VM stack convention (RAM at and above SP holds nothing live), and it only
+jumps to labels, never to numeric ROM addresses, since removing instructions moves every later address"""
+import argparse
+import sys
+
+from HackAssembler import clean_line
+
+# push D onto the stack, immediately followed by popping the stack into D
+PUSH_POP_D = ["@SP", "AM=M+1", "A=A-1", "M=D", "@SP", "AM=M-1", "D=M"]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Writes a peephole optimized copy of a hack .asm file")
+    arg_parser.add_argument("input_file", metavar="Xxx.asm")
+    args = arg_parser.parse_args()
+
+    input_file = args.input_file
+    # output file name is the same as input, but with .opt.asm rather than .asm
+    output_file = input_file[:-3] + "opt.asm"
+
+    with open(input_file, "r") as program:
+        lines, removed = optimize(program)
+
+    with open(output_file, "w") as out:
+        for line in lines:
+            out.write(line + "\n")
+    print_report(removed)
+
+
+def optimize(lines):
+    """:returns (list of optimized clean instructions and labels, {rule name: instructions removed})
+    given an iterable of hack assembly lines. Rules are applied until none of them changes the program"""
+    lines = [line for line in map(clean_line, lines) if line != ""]
+    removed = {rule.__name__: 0 for rule in RULES}
+
+    changed = True
+    while changed:
+        changed = False
+        for rule in RULES:
+            optimized = rule(lines)
+            if len(optimized) < len(lines):
+                removed[rule.__name__] += len(lines) - len(optimized)
+                lines = optimized
+                changed = True
+
+    return lines, removed
+
+
+def print_report(removed, file=sys.stdout):
+    for rule, count in removed.items():
+        print(f"{rule}: {count} instructions removed", file=file)
+    print(f"total: {sum(removed.values())} instructions removed", file=file)
+
+
+def is_label(line):
+    return line.startswith("(")
+
+
+def is_a_command(line):
+    return line.startswith("@")
+
+
+def split_c_command(line):
+    """:returns (dest, comp, jump) of a clean c instruction, using "" for missing parts"""
+    dest, _, comp = line.rpartition("=")
+    comp, _, jump = comp.partition(";")
+    return dest, comp, jump
+
+
+def uses_a(line):
+    """:returns whether the instruction's effect depends on the value of A before it runs"""
+    if is_a_command(line) or is_label(line):
+        return False
+    dest, comp, jump = split_c_command(line)
+    return "A" in comp or "M" in comp or "M" in dest or jump != ""
+
+
+def writes_a(line):
+    return not is_label(line) and not is_a_command(line) and "A" in split_c_command(line)[0]
+
+
+def is_bare_jump(line):
+    """:returns whether line is a jump that does nothing else (no dest), such as 0;JMP or D;JNE"""
+    if is_label(line) or is_a_command(line):
+        return False
+    dest, comp, jump = split_c_command(line)
+    return dest == "" and jump != ""
+
+
+def next_instruction(lines, i):
+    """:returns (index of the first instruction at or after i, set of labels skipped on the way)"""
+    labels = set()
+    while i < len(lines) and is_label(lines[i]):
+        labels.add(lines[i][1:-1])
+        i += 1
+    return i, labels
+
+
+def push_pop(lines):
+    """Pushing D and popping it straight back leaves only A = SP behind, which a following A command overwrites"""
+    optimized = []
+    i = 0
+    while i < len(lines):
+        if lines[i] == "@SP" and lines[i:i + len(PUSH_POP_D)] == PUSH_POP_D:
+            i += len(PUSH_POP_D)
+            if i >= len(lines) or not is_a_command(lines[i]):
+                optimized += ["@SP", "A=M"]
+            continue
+        optimized.append(lines[i])
+        i += 1
+    return optimized
+
+
+def jump_to_next(lines):
+    """A jump to the label right after it lands in the same place whether it is taken or not"""
+    optimized = []
+    i = 0
+    while i < len(lines):
+        if is_a_command(lines[i]) and i + 1 < len(lines) and is_bare_jump(lines[i + 1]):
+            after, labels = next_instruction(lines, i + 2)
+            # a jump would have left A = label, so the code after it must not depend on A
+            if lines[i][1:] in labels and a_is_dead(lines, after):
+                i += 2
+                continue
+        optimized.append(lines[i])
+        i += 1
+    return optimized
+
+
+def a_is_dead(lines, i):
+    """:returns whether the value A holds before lines[i] is overwritten before any instruction reads it.
+    Gives up (returns False) at a label or a jump, since whatever runs after those is not known here"""
+    for line in lines[i:]:
+        if is_label(line) or uses_a(line):
+            return False
+        if is_a_command(line) or writes_a(line):
+            return True
+    return True
+
+
+def unreachable(lines):
+    """Instructions after an unconditional jump and before the next label can never run"""
+    optimized = []
+    reachable = True
+    for line in lines:
+        if is_label(line):
+            reachable = True
+        if reachable:
+            optimized.append(line)
+        if not is_label(line) and not is_a_command(line) and split_c_command(line)[2] == "JMP":
+            reachable = False
+    return optimized
+
+
+def redundant_a(lines):
+    """Drops A commands whose value is overwritten by the next A command, or that A already holds"""
+    optimized = []
+    # the A command whose value A currently holds, if known
+    current_a = None
+    for i, line in enumerate(lines):
+        if is_label(line):
+            current_a = None
+        elif is_a_command(line):
+            if line == current_a or (i + 1 < len(lines) and is_a_command(lines[i + 1])):
+                continue
+            current_a = line
+        elif writes_a(line):
+            current_a = None
+        optimized.append(line)
+    return optimized
+
+
+def fold_a(lines):
+    """A=M immediately followed by A=A-1 is A=M-1, which push_pop leaves in front of binary operations"""
+    optimized = []
+    for line in lines:
+        if line == "A=A-1" and optimized and optimized[-1] == "A=M":
+            optimized[-1] = "A=M-1"
+            continue
+        optimized.append(line)
+    return optimized
+
+
+RULES = [push_pop, jump_to_next, unreachable, redundant_a, fold_a]
+
+
+if __name__ == '__main__':
+    main()
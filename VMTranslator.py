@@ -1,432 +1,1192 @@
-import sys
-import os
-
-# Define constants
-C_RETURN = 0
-C_ARITHMETIC = 1
-C_PUSH = 2
-C_POP = 3
-C_LABEL = 4
-C_GOTO = 5
-C_IF = 6
-C_CALL = 7
-C_FUNCTION = 8
-
-mem_seg_to_pointer = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
-# keep track of times we used labels to make unique ones
-num_labeled = 0
-file_name = ""
-
-
-def main(file_or_dir):
-    global file_name
-    input_files = []
-    if os.path.isdir(file_or_dir):
-        for (dirpath, dirnames, filenames) in os.walk(file_or_dir):
-            for file in filenames:
-                if file.endswith(".vm"):
-                    input_files.append(os.path.join(dirpath, file))
-        if file_or_dir.endswith("/"):
-            file_name = os.path.basename(file_or_dir[:-1])
-        else:
-            file_name = os.path.basename(file_or_dir)
-        output_file = file_name + ".asm"
-
-    elif file_or_dir.endswith(".vm"):
-        input_files = [file_or_dir]
-        file_name = file_or_dir[:-3]
-        output_file = file_name + ".asm"  # same filename but with .asm rather than .vm
-    else:
-        print("Usage python VMTranslator XXX.vm || python VMTranslator my_directory/ ")
-        return
-
-    with open(output_file, "w") as asm:
-        if os.path.isdir(file_or_dir):
-            # begin with initialization code if directory was the input
-            for instruction in get_init():
-                asm.write(instruction + "\n")
-
-        # then go through files, translating contents
-        for this_input_file in input_files:
-            file_name = os.path.basename(this_input_file)  # for use in generating labels and variables such as Foo.my_var
-            current_function = ""
-            with open(this_input_file, "r") as vm:
-                for command in vm:
-                    # ignore everything after // and remove outer whitespace
-                    command = command.split("//")[0].strip()
-                    # skip lines that do not contain a command
-                    if command == "":
-                        continue
-
-                    # Parse command and use command_type to determine which sequence of assembly instructions to write
-                    command_type, arg1, arg2 = parse(command)
-                    asm_instructions = []
-                    if command_type == C_ARITHMETIC:
-                        asm_instructions = get_arithmetic(arg1)
-                    elif command_type == C_PUSH:
-                        asm_instructions = get_push(arg1, arg2)
-                    elif command_type == C_POP:
-                        asm_instructions = get_pop(arg1, arg2)
-                    elif command_type == C_RETURN:
-                        asm_instructions = get_return()
-                    elif command_type == C_LABEL:
-                        asm_instructions = get_label(arg1, current_function)
-                    elif command_type == C_GOTO:
-                        asm_instructions = get_goto(arg1, current_function)
-                    elif command_type == C_IF:
-                        asm_instructions = get_if_goto(arg1, current_function)
-                    elif command_type == C_CALL:
-                        asm_instructions = get_call(arg1, arg2, current_function)
-                    elif command_type == C_FUNCTION:
-                        asm_instructions = get_function(arg1, arg2)
-                        current_function = arg1
-
-                    # write the assembly instructions to asm
-                    for instruction in asm_instructions:
-                        asm.write(instruction + "\n")
-
-
-def parse(command):
-    """:returns (const command_type, str ar1, int arg2) given a clean vm command
-    command_type = one of [C_ARITHMETIC, C_PUSH, C_POP, ...] where C_ARITHMETIC encapsulates arithmetic and logic
-    arg1 = first argument ("add", "sub", etc are the first arguments to a C_ARITHMETIC) or None if command is C_RETURN
-    arg2 = second argument or None if C_ARITHMETIC or C_RETURN
-    """
-    command_map = {
-        "return": C_RETURN,
-        "add": C_ARITHMETIC,
-        "sub": C_ARITHMETIC,
-        "neg": C_ARITHMETIC,
-        "eq": C_ARITHMETIC,
-        "gt": C_ARITHMETIC,
-        "lt": C_ARITHMETIC,
-        "and": C_ARITHMETIC,
-        "or": C_ARITHMETIC,
-        "not": C_ARITHMETIC,
-        "label": C_LABEL,
-        "goto": C_GOTO,
-        "if-goto": C_IF,
-        "push": C_PUSH,
-        "pop": C_POP,
-        "call": C_CALL,
-        "function": C_FUNCTION
-    }
-    tokens = command.split()
-    if len(tokens) == 1:
-        # for return or arithmetic, if return, main will simply ignore arg1
-        return command_map[tokens[0]], tokens[0], None
-    elif len(tokens) == 2:
-        # for label, goto, or if-goto
-        return command_map[tokens[0]], tokens[1], None
-    elif len(tokens) == 3:
-        # for function, call, push, or pop
-        return command_map[tokens[0]], tokens[1], tokens[2]
-
-
-def get_arithmetic(operation):
-    """:returns list of hack assembly instructions to perform operation on the top 1 or 2 stack items"""
-    if operation == "add" or operation == "sub":
-        op = "+" if operation == "add" else "-"
-        return [
-            f"// {operation}",
-            "@SP",
-            "AM=M-1",
-            "D=M",
-            "A=A-1",
-            f"M=M{op}D"
-        ]
-    elif operation == "neg" or operation == "not":
-        op = "-" if operation == "neg" else "!"
-        return [
-            f"// {operation}",
-            "@SP",
-            "A=M-1",
-            f"M={op}M"
-        ]
-    elif operation == "eq" or operation == "gt" or operation == "lt":
-        jump_op = {"eq": "JNE", "gt": "JLE", "lt": "JGE"}[operation]
-        global num_labeled
-        num_labeled += 1
-        return [
-            f"// {operation}",
-            "@SP",
-            "AM=M-1",
-            "D=M",
-            "A=A-1",
-            "D=M-D",
-            f"@Not{operation + str(num_labeled)}",
-            f"D; {jump_op}",
-            "@SP",
-            "A=M-1",
-            "M=-1",
-            f"@End{operation + str(num_labeled)}",
-            "0; JMP",
-            f"(Not{operation + str(num_labeled)})",
-            "@SP",
-            "A=M-1",
-            "M=0",
-            f"(End{operation + str(num_labeled)})"
-        ]
-    elif operation == "and" or operation == "or":
-        op = "&" if operation == "and" else "|"
-        return [
-            f"// {operation}",
-            "@SP",
-            "AM=M-1",
-            "D=M",
-            "A=A-1",
-            f"M=D{op}M"
-        ]
-    else:
-        return []
-
-
-def get_push(mem_seg, index):
-
-    if mem_seg == "constant":
-        """:returns list of hack assembly instructions to push mem_seg index"""
-        return [
-            f"// push constant {index}",
-            "@" + str(index),
-            "D=A",
-            "@SP",
-            "AM=M+1",
-            "A=A-1",
-            "M=D"
-        ]
-    elif mem_seg == "static" or mem_seg == "temp":
-        global file_name
-        # storage can be Foo.3 or R8 if index = 3
-        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
-        return [
-            f"// push {mem_seg} {index}",
-            f"@{storage}",
-            "D=M",
-            "@SP",
-            "AM=M+1",
-            "A=A-1",
-            "M=D"
-        ]
-    elif mem_seg == "pointer":
-        pointer = "THIS" if index == "0" else "THAT"
-        return [
-            f"// push {mem_seg} {index}",
-            f"@{pointer}",
-            "D=M",
-            "@SP",
-            "AM=M+1",
-            "A=A-1",
-            "M=D"
-        ]
-    else:  # mem_seg = local, argument, this, that
-        return [
-            f"// push {mem_seg} {index}",
-            "@" + str(index),
-            "D=A",
-            "@" + mem_seg_to_pointer[mem_seg],
-            "A=D+M",
-            "D=M",
-            "@SP",
-            "AM=M+1",
-            "A=A-1",
-            "M=D",
-        ]
-
-
-def get_pop(mem_seg, index):
-    """:returns list of hack assembly instructions to pop mem_seg index"""
-    if mem_seg == "static" or mem_seg == "temp":
-        global file_name
-        # storage can be Foo.3 or R8 if index = 3
-        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
-        return [
-            f"// pop {mem_seg} {index}",
-            "@SP",
-            "AM=M-1",
-            "D=M",
-            f"@{storage}",
-            "M=D"
-        ]
-    elif mem_seg == "pointer":
-        pointer = "THIS" if index == "0" else "THAT"
-        return [
-            f"// pop {mem_seg} {index}",
-            "@SP",
-            "AM=M-1",
-            "D=M",
-            f"@{pointer}",
-            "M=D"
-        ]
-    else:   # mem_seg = local, argument, this, that
-        return [
-            f"// pop {mem_seg} {index}",
-            "@" + str(index),
-            "D=A",
-            "@" + mem_seg_to_pointer[mem_seg],
-            "D=D+M",
-            "@SP",
-            "AM=M-1",
-            "D=D+M",
-            "A=D-M",
-            "M=D-A"
-        ]
-
-
-def get_label(label_name, function_name):
-    """:returns label declaration, using Foo$bar syntax for
-    label bar in function Foo"""
-    return [
-        f"// label {label_name}",
-        f"({function_name}${label_name})"]
-
-
-def get_init():
-    asm_code = [
-        "// init",
-        "@256",
-        "D=A",
-        "@SP",
-        "M=D"
-    ]
-    return asm_code + get_call("Sys.init", "0", "init")
-
-
-def get_function(function_name, n_vars):
-    asm_code = [
-        f"// function {function_name} {n_vars}",
-        f"({function_name})"]
-    n_vars = int(n_vars)
-    if n_vars >= 1:
-        asm_code.append("@SP")
-        asm_code.append("A=M")
-        asm_code.append("M=0")
-        # repeat block
-        for i in range(n_vars - 1):
-            asm_code.append("AD=A+1")
-            asm_code.append("M=0")
-        if n_vars >= 2:
-            asm_code.append("@SP")
-            asm_code.append("M=D")
-
-    return asm_code
-
-
-def get_call(callee, n_args, caller):
-    global num_labeled
-    num_labeled += 1
-    return_address = f"{caller}$ret.{num_labeled}"
-    return [
-        f'// call {callee} {n_args}',
-        f'@{return_address}',
-        'D=A',
-        '@SP',
-        'A=M',
-        'M=D',
-        'D=A+1',
-        '@LCL',
-        'D=D+M',
-        'A=D-M',
-        'M=D-A',
-        'D=A+1',
-        '@ARG',
-        'D=D+M',
-        'A=D-M',
-        'M=D-A',
-        'D=A+1',
-        '@THIS',
-        'D=D+M',
-        'A=D-M',
-        'M=D-A',
-        'D=A+1',
-        '@THAT',
-        'D=D+M',
-        'A=D-M',
-        'M=D-A',
-        '@SP',
-        'D=M',
-        f'@{n_args}',
-        'D=D-A',
-        '@ARG',
-        'M=D',
-        '@5',
-        'D=A',
-        '@SP',
-        'MD=M+D',
-        '@LCL',
-        'M=D',
-        f'@{callee}',
-        '0; JMP',
-        f'({return_address})'
-    ]
-
-
-def get_return():
-    return [
-        '// return',
-        '@LCL',
-        'D=M',
-        '@5',
-        'A=D-A',
-        'D=M',
-        '@retAddr',
-        'M=D',
-        '@SP',
-        'A=M-1',
-        'D=M',
-        '@ARG',
-        'A=M',
-        'M=D',
-        '@ARG',
-        'D=M+1',
-        '@SP',
-        'M=D',
-        '@LCL',
-        'AM=M-1',
-        'D=M',
-        '@THAT',
-        'M=D',
-        '@LCL',
-        'AM=M-1',
-        'D=M',
-        '@THIS',
-        'M=D',
-        '@LCL',
-        'AM=M-1',
-        'D=M',
-        '@ARG',
-        'M=D',
-        '@LCL',
-        'AM=M-1',
-        'D=M',
-        '@LCL',
-        'M=D',
-        '@retAddr',
-        'A=M',
-        '0; JMP'
-    ]
-
-
-def get_goto(label_name, function_name):
-    return [
-        f"// goto {label_name}",
-        f"@{function_name}${label_name}",
-        "0; JMP"
-    ]
-
-
-def get_if_goto(label_name, function_name):
-    return [
-        f"// if-goto {label_name}",
-        "@SP",
-        "AM=M-1",
-        "D=M",
-        f"@{function_name}${label_name}",
-        "D; JNE"
-    ]
-
-
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage python VMTranslator XXX.vm || python VMTranslator my_directory/ ")
-        sys.exit(1)
-    main(sys.argv[1])
+import argparse
+import hashlib
+import io
+import json
+import sys
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Define constants
+C_RETURN = 0
+C_ARITHMETIC = 1
+C_PUSH = 2
+C_POP = 3
+C_LABEL = 4
+C_GOTO = 5
+C_IF = 6
+C_CALL = 7
+C_FUNCTION = 8
+
+mem_seg_to_pointer = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+# keep track of times we used labels to make unique ones
+num_labeled = 0
+file_name = ""
+# prefixed to the labels made unique by num_labeled, so that files translated separately (see translate_file) get
+# labels of their own such as Foo.vm$Noteq3 even though each of them counts from 0
+label_scope = ""
+# with trampolines, calls and returns jump to one shared call routine and one shared return routine (see
+# get_trampolines) rather than inlining them
+trampolines = False
+# with shared_comparisons, eq, gt and lt jump to one shared routine per operator (see get_comparison_routine),
+# and comparisons_used holds the operators whose routines have to be written after the program
+shared_comparisons = False
+comparisons_used = set()
+# with stack_caching, commands are translated by get_cached, and top_in_d tracks whether the top of the stack is
+# held in D at this point of the translated program rather than at RAM[SP-1] (SP then does not count it)
+stack_caching = False
+top_in_d = False
+# with fusion, short runs of commands matching FUSION_PATTERNS are translated together by get_fused, without going
+# through the stack, and fusion_hits counts the runs fused for each pattern
+fusion = False
+fusion_hits = {}
+# with dead function elimination, only the functions in reachable_functions (see find_reachable) are written, and
+# the others are counted in dropped_functions and dropped_rom_size
+reachable_functions = None
+function_count = 0
+dropped_functions = 0
+dropped_rom_size = 0
+# instructions and labels written so far, and how many the same program would take without shared routines
+rom_size = 0
+label_count = 0
+inline_rom_size = 0
+inline_label_count = 0
+NO_SYS_INIT = "Dead function elimination starts from Sys.init, which the program does not define"
+USAGE = "Usage python VMTranslator XXX.vm || python VMTranslator my_directory/ || python VMTranslator - (stdin to stdout)"
+
+
+def main(file_or_dir, use_trampolines=False, use_shared_comparisons=False, use_stack_caching=False,
+         use_fusion=False, eliminate_dead_functions=False, jobs=1, cache_dir=None, run_benchmark=False):
+    global file_name, trampolines, shared_comparisons, stack_caching, fusion, reachable_functions
+    trampolines = use_trampolines
+    shared_comparisons = use_shared_comparisons
+    stack_caching = use_stack_caching
+    fusion = use_fusion
+    input_files = []
+    if eliminate_dead_functions and not (file_or_dir == "-" or os.path.isdir(file_or_dir)):
+        print("Dead function elimination needs a whole program (a directory or -) to start from Sys.init",
+              file=sys.stderr)
+        return
+
+    if file_or_dir == "-":
+        # stream a whole program from stdin to stdout, so the translator can sit in a pipeline
+        vm = sys.stdin
+        if eliminate_dead_functions:
+            # the whole program has to be read to know which functions it calls
+            vm = sys.stdin.readlines()
+            call_graph = read_call_graph(vm, {})
+            if "Sys.init" not in call_graph:
+                print(NO_SYS_INIT, file=sys.stderr)
+                return
+            reachable_functions = find_reachable(call_graph)
+        write_instructions(sys.stdout, get_init())
+        translate(vm, sys.stdout, stream=True)
+        finish(sys.stdout)
+        return
+
+    if os.path.isdir(file_or_dir):
+        for (dirpath, dirnames, filenames) in os.walk(file_or_dir):
+            for file in filenames:
+                if file.endswith(".vm"):
+                    input_files.append(os.path.join(dirpath, file))
+        if file_or_dir.endswith("/"):
+            file_name = os.path.basename(file_or_dir[:-1])
+        else:
+            file_name = os.path.basename(file_or_dir)
+        output_file = file_name + ".asm"
+
+    elif file_or_dir.endswith(".vm"):
+        input_files = [file_or_dir]
+        file_name = file_or_dir[:-3]
+        output_file = file_name + ".asm"  # same filename but with .asm rather than .vm
+    else:
+        print(USAGE)
+        return
+
+    if eliminate_dead_functions:
+        call_graph = {}
+        for this_input_file in input_files:
+            with open(this_input_file, "r") as vm:
+                read_call_graph(vm, call_graph)
+        if "Sys.init" not in call_graph:
+            print(NO_SYS_INIT, file=sys.stderr)
+            return
+        reachable_functions = find_reachable(call_graph)
+
+    if run_benchmark:
+        benchmark(input_files)
+        return
+
+    translated_files = None
+    if jobs > 1 or cache_dir is not None:
+        translated_files = translate_files(input_files, jobs, cache_dir)
+        reset_state()
+
+    with open(output_file, "w") as asm:
+        if os.path.isdir(file_or_dir):
+            # begin with initialization code if directory was the input
+            write_instructions(asm, get_init())
+
+        if translated_files is not None:
+            for asm_code, counters in translated_files:
+                asm.write(asm_code)
+                add_counters(counters)
+            finish(asm)
+            return
+
+        # then go through files, translating contents
+        for this_input_file in input_files:
+            file_name = os.path.basename(this_input_file)  # for use in generating labels and variables such as Foo.my_var
+            with open(this_input_file, "r") as vm:
+                translate(vm, asm)
+        finish(asm)
+
+
+def init_worker(use_trampolines, use_shared_comparisons, use_stack_caching, use_fusion, functions):
+    global trampolines, shared_comparisons, stack_caching, fusion, reachable_functions
+    trampolines = use_trampolines
+    shared_comparisons = use_shared_comparisons
+    stack_caching = use_stack_caching
+    fusion = use_fusion
+    reachable_functions = functions
+
+
+def benchmark(input_files, repeat=5):
+    """Times translating input_files (read into memory first) and prints the best vm lines translated per second"""
+    global file_name
+    vm_files = []
+    for input_file in input_files:
+        with open(input_file, "r") as vm:
+            vm_files.append((os.path.basename(input_file), vm.readlines()))
+    vm_lines = sum(len(lines) for _, lines in vm_files)
+    best = float("inf")
+    for _ in range(repeat):
+        reset_state()
+        asm = io.StringIO()
+        start = time.perf_counter()
+        for file_name, lines in vm_files:
+            translate(lines, asm)
+        best = min(best, time.perf_counter() - start)
+    asm_lines = asm.getvalue().count("\n")
+    print(f"{vm_lines} vm lines to {asm_lines} assembly lines, {vm_lines / best:,.0f} vm lines translated per second")
+
+
+def translate_files(input_files, jobs=1, cache_dir=None):
+    """:returns list of the (hack assembly, counters) of each of input_files from translate_file, translating them
+    in a pool of jobs worker processes if jobs > 1. With cache_dir, files translated before with the same content
+    and options are not translated again, and the cache hits and misses are reported on stderr"""
+    translated_files = [None] * len(input_files)
+    keys = []
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(__file__, "rb") as translator:
+            version = hashlib.sha256(translator.read()).hexdigest()
+        for i, input_file in enumerate(input_files):
+            keys.append(cache_key(input_file, version))
+            translated_files[i] = load_cached(cache_dir, keys[i])
+    dirty = [i for i, translated_file in enumerate(translated_files) if translated_file is None]
+
+    if jobs > 1:
+        options = (trampolines, shared_comparisons, stack_caching, fusion, reachable_functions)
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=options) as pool:
+            translated_dirty = list(pool.map(translate_file, [input_files[i] for i in dirty]))
+    else:
+        translated_dirty = [translate_file(input_files[i]) for i in dirty]
+    for i, translated_file in zip(dirty, translated_dirty):
+        translated_files[i] = translated_file
+        if cache_dir is not None:
+            store_cached(cache_dir, keys[i], translated_file)
+
+    if cache_dir is not None:
+        print(f"cache: {len(input_files) - len(dirty)} hits, {len(dirty)} misses", file=sys.stderr)
+    return translated_files
+
+
+def translate_file(input_file):
+    """:returns (the hack assembly of input_file, the counters it adds to, as add_counters takes them), for use in
+    worker processes. Labels are scoped to the file and numbered from 0, so the result only depends on the file"""
+    global file_name
+    file_name = os.path.basename(input_file)
+    reset_state(file_name + "$")
+    asm = io.StringIO()
+    with open(input_file, "r") as vm:
+        translate(vm, asm)
+    counters = (sorted(comparisons_used), fusion_hits, function_count, dropped_functions, dropped_rom_size,
+                rom_size, label_count, inline_rom_size, inline_label_count)
+    return asm.getvalue(), counters
+
+
+def reset_state(scope=""):
+    """Starts the label numbering, in label_scope scope, and the counters of a translation over"""
+    global num_labeled, label_scope, top_in_d, comparisons_used, fusion_hits, function_count, dropped_functions, \
+        dropped_rom_size, rom_size, label_count, inline_rom_size, inline_label_count
+    num_labeled = 0
+    label_scope = scope
+    top_in_d = False
+    comparisons_used = set()
+    fusion_hits = {}
+    function_count = dropped_functions = dropped_rom_size = 0
+    rom_size = label_count = inline_rom_size = inline_label_count = 0
+
+
+def cache_key(input_file, version):
+    """:returns the name of the cache entry for input_file: a hash of its name and content, the version of the
+    translator and the options, which are everything translate_file's result depends on"""
+    with open(input_file, "rb") as vm:
+        content = vm.read()
+    options = [trampolines, shared_comparisons, stack_caching, fusion]
+    if reachable_functions is not None:
+        # only the functions of this file that are dropped change its translation
+        functions = read_call_graph(content.decode().splitlines(), {})
+        options.append(sorted(function for function in functions if function not in reachable_functions))
+    key = hashlib.sha256(version.encode())
+    key.update(json.dumps([os.path.basename(input_file), options]).encode())
+    key.update(content)
+    return key.hexdigest()
+
+
+def load_cached(cache_dir, key):
+    """:returns the translate_file result cached under key, or None if there is none"""
+    try:
+        with open(os.path.join(cache_dir, key + ".json"), "r") as cached:
+            asm_code, counters = json.load(cached)
+    except (OSError, ValueError):
+        return None
+    return asm_code, counters
+
+
+def store_cached(cache_dir, key, translated_file):
+    cache_file = os.path.join(cache_dir, key + ".json")
+    # write to a temporary file first, so that an interrupted build never leaves a partial entry behind
+    with open(cache_file + ".tmp", "w") as cached:
+        json.dump(translated_file, cached, separators=(",", ":"))
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+def add_counters(counters):
+    """Adds the counters of a file translated by translate_file to the totals of the program"""
+    global function_count, dropped_functions, dropped_rom_size, rom_size, label_count, inline_rom_size, \
+        inline_label_count
+    used, hits, functions, dropped, dropped_size, size, labels, inline_size, inline_labels = counters
+    comparisons_used.update(used)
+    for pattern, count in hits.items():
+        fusion_hits[pattern] = fusion_hits.get(pattern, 0) + count
+    function_count += functions
+    dropped_functions += dropped
+    dropped_rom_size += dropped_size
+    rom_size += size
+    label_count += labels
+    inline_rom_size += inline_size
+    inline_label_count += inline_labels
+
+
+def finish(asm):
+    """Writes the shared routines the program jumps to after it, and reports the size of the program with and
+    without them and the fusion_hits on stderr"""
+    global rom_size, label_count
+    if reachable_functions is not None:
+        print(f"dead functions: dropped {dropped_functions} of {function_count} functions "
+              f"({dropped_rom_size} instructions)", file=sys.stderr)
+    if fusion:
+        print("fused: " + ", ".join(f"{pattern} {fusion_hits.get(pattern, 0)}" for pattern in FUSION_PATTERNS),
+              file=sys.stderr)
+    if not trampolines and not shared_comparisons:
+        return
+    shared_instructions = get_trampolines() if trampolines else []
+    for operation in sorted(comparisons_used):
+        shared_instructions += get_comparison_routine(operation)
+    rom_size += count_instructions(shared_instructions)
+    label_count += count_labels(shared_instructions)
+    for instruction in shared_instructions:
+        asm.write(instruction + "\n")
+    saved = inline_rom_size - rom_size
+    print(f"ROM: {rom_size} instructions and {label_count} labels with shared routines, {inline_rom_size} "
+          f"instructions and {inline_label_count} labels without ({saved} instructions or "
+          f"{100 * saved / max(inline_rom_size, 1):.1f}% smaller)", file=sys.stderr)
+
+
+def write_instructions(asm, asm_instructions):
+    """Writes the list of asm_instructions to asm, counting them towards rom_size and label_count, and towards
+    inline_rom_size and inline_label_count as they would be with every jump to a shared routine inlined"""
+    global rom_size, label_count, inline_rom_size, inline_label_count
+    if not asm_instructions:
+        return
+    # every instruction starts a line of text, so counting line starts is cheaper than looking at each instruction
+    text = "\n" + "\n".join(asm_instructions)
+    labels = text.count("\n(")
+    size = len(asm_instructions) - labels - text.count("\n//")
+    rom_size += size
+    label_count += labels
+    inline_rom_size += size
+    inline_label_count += labels
+    if trampolines or shared_comparisons:
+        for instruction in asm_instructions:
+            if instruction in SHARED_ROUTINE_SAVINGS:
+                inline_rom_size += SHARED_ROUTINE_SAVINGS[instruction][0]
+                inline_label_count += SHARED_ROUTINE_SAVINGS[instruction][1]
+    # one write per command rather than per instruction
+    asm.write(text[1:] + "\n")
+
+
+def count_instructions(asm_instructions):
+    """:returns how many of the asm_instructions take up ROM (everything but comments and labels)"""
+    return sum(1 for instruction in asm_instructions if not instruction.startswith(("//", "(")))
+
+
+def count_labels(asm_instructions):
+    return sum(1 for instruction in asm_instructions if instruction.startswith("("))
+
+
+def translate(vm, asm, stream=False):
+    """Translates the lines of vm commands in vm, writing the hack assembly instructions to asm
+    With stream=True, vm may hold several classes one after the other, so static variables are named after the
+    class of the current function (as if each class had come from its own Class.vm file)"""
+    global file_name, function_count, dropped_functions, dropped_rom_size, top_in_d
+    # a file is translated into a buffer and written in one go, while a stream is written as it is translated
+    out = asm if stream else io.StringIO()
+    current_function = ""
+    # whether the current function is dead, so its instructions are only counted
+    dead = False
+    commands = read_commands(vm)
+    for command_type, arg1, arg2 in (fuse(commands) if fusion else commands):
+        # use command_type to determine which sequence of assembly instructions to write
+        asm_instructions = []
+        if command_type in FUSION_PATTERNS:
+            asm_instructions = get_fused(command_type, arg1, current_function)
+        elif stack_caching:
+            asm_instructions = get_cached(command_type, arg1, arg2, current_function)
+        elif command_type == C_ARITHMETIC:
+            asm_instructions = get_arithmetic(arg1)
+        elif command_type == C_PUSH:
+            asm_instructions = get_push(arg1, arg2)
+        elif command_type == C_POP:
+            asm_instructions = get_pop(arg1, arg2)
+        elif command_type == C_RETURN:
+            asm_instructions = get_return()
+        elif command_type == C_LABEL:
+            asm_instructions = get_label(arg1, current_function)
+        elif command_type == C_GOTO:
+            asm_instructions = get_goto(arg1, current_function)
+        elif command_type == C_IF:
+            asm_instructions = get_if_goto(arg1, current_function)
+        elif command_type == C_CALL:
+            asm_instructions = get_call(arg1, arg2, current_function)
+        elif command_type == C_FUNCTION:
+            asm_instructions = get_function(arg1, arg2)
+        if command_type == C_FUNCTION:
+            current_function = arg1
+            if stream:
+                file_name = arg1.split(".")[0] + ".vm"
+            dead = reachable_functions is not None and arg1 not in reachable_functions
+            function_count += 1
+            dropped_functions += dead
+
+        if dead:
+            dropped_rom_size += count_instructions(asm_instructions)
+            continue
+        # write the assembly instructions to asm
+        write_instructions(out, asm_instructions)
+
+    if stack_caching:
+        # leave the stack in RAM for whatever comes after this file
+        write_instructions(out, get_flush())
+        top_in_d = False
+    if out is not asm:
+        asm.write(out.getvalue())
+
+
+def read_commands(vm):
+    """Generator of the parsed (command_type, arg1, arg2) commands in the lines of vm"""
+    for command in vm:
+        # ignore everything after // and remove outer whitespace
+        command = command.split("//")[0].strip()
+        # skip lines that do not contain a command
+        if command == "":
+            continue
+        yield parse(command)
+
+
+def read_call_graph(vm, call_graph):
+    """Adds the functions in the lines of vm to call_graph, a dict of function name -> set of functions it calls,
+    and :returns call_graph"""
+    current_function = None
+    for command_type, arg1, _ in read_commands(vm):
+        if command_type == C_FUNCTION:
+            current_function = arg1
+            call_graph.setdefault(current_function, set())
+        elif command_type == C_CALL and current_function is not None:
+            call_graph[current_function].add(arg1)
+    return call_graph
+
+
+def find_reachable(call_graph, root="Sys.init"):
+    """:returns the set of functions that can run starting from root: VM code only calls functions by name, so
+    these are root and every function a reachable function calls"""
+    reachable = {root}
+    to_visit = [root]
+    while to_visit:
+        for callee in call_graph.get(to_visit.pop(), ()):
+            if callee not in reachable:
+                reachable.add(callee)
+                to_visit.append(callee)
+    return reachable
+
+
+def fuse(commands):
+    """Generator of the parsed commands, except that runs of commands matching one of the FUSION_PATTERNS are
+    replaced by (pattern, list of the commands, None)"""
+    window = deque()
+    longest = max(len(FUSION_PATTERNS[pattern]) for pattern in FUSION_PATTERNS)
+    for command in commands:
+        window.append(command)
+        if len(window) == longest:
+            yield fuse_next(window)
+    while window:
+        yield fuse_next(window)
+
+
+def fuse_next(window):
+    """Removes the first command, or the first run of commands matching a fusion pattern, from the deque window,
+    :returns it as fuse yields it"""
+    for pattern, command_patterns in FUSION_PATTERNS.items():
+        if len(window) >= len(command_patterns) and \
+                all(fusion_matches(command, command_pattern) for command, command_pattern in
+                    zip(window, command_patterns)):
+            fusion_hits[pattern] = fusion_hits.get(pattern, 0) + 1
+            return pattern, [window.popleft() for _ in command_patterns], None
+    return window.popleft()
+
+
+def fusion_matches(command, command_pattern):
+    command_type, arg1, _ = command
+    if command_pattern == "push":
+        return command_type == C_PUSH
+    elif command_pattern == "pop":
+        return command_type == C_POP
+    elif command_pattern == "if-goto":
+        return command_type == C_IF
+    elif command_pattern == "unary":
+        return command_type == C_ARITHMETIC and (arg1 == "neg" or arg1 == "not")
+    return command_type == C_ARITHMETIC and arg1 in FUSED_OPERATIONS
+
+
+def parse(command):
+    """:returns (const command_type, str ar1, int arg2) given a clean vm command
+    command_type = one of [C_ARITHMETIC, C_PUSH, C_POP, ...] where C_ARITHMETIC encapsulates arithmetic and logic
+    arg1 = first argument ("add", "sub", etc are the first arguments to a C_ARITHMETIC) or None if command is C_RETURN
+    arg2 = second argument or None if C_ARITHMETIC or C_RETURN
+    """
+    tokens = command.split()
+    if len(tokens) == 1:
+        # for return or arithmetic, if return, main will simply ignore arg1
+        return COMMAND_MAP[tokens[0]], tokens[0], None
+    elif len(tokens) == 2:
+        # for label, goto, or if-goto
+        return COMMAND_MAP[tokens[0]], tokens[1], None
+    elif len(tokens) == 3:
+        # for function, call, push, or pop
+        return COMMAND_MAP[tokens[0]], tokens[1], tokens[2]
+
+
+def get_arithmetic(operation):
+    """:returns list of hack assembly instructions to perform operation on the top 1 or 2 stack items"""
+    if operation == "add" or operation == "sub":
+        op = "+" if operation == "add" else "-"
+        return [
+            f"// {operation}",
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "A=A-1",
+            f"M=M{op}D"
+        ]
+    elif operation == "neg" or operation == "not":
+        op = "-" if operation == "neg" else "!"
+        return [
+            f"// {operation}",
+            "@SP",
+            "A=M-1",
+            f"M={op}M"
+        ]
+    elif operation == "eq" or operation == "gt" or operation == "lt":
+        global num_labeled
+        num_labeled += 1
+        if shared_comparisons:
+            comparisons_used.add(operation)
+            return get_comparison_jump(operation, f"{label_scope}VM${operation}$ret.{num_labeled}")
+        return get_inline_comparison(operation, num_labeled)
+    elif operation == "and" or operation == "or":
+        op = "&" if operation == "and" else "|"
+        return [
+            f"// {operation}",
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "A=A-1",
+            f"M=D{op}M"
+        ]
+    else:
+        return []
+
+
+def get_inline_comparison(operation, label_number):
+    jump_op = {"eq": "JNE", "gt": "JLE", "lt": "JGE"}[operation]
+    return [
+        f"// {operation}",
+        "@SP",
+        "AM=M-1",
+        "D=M",
+        "A=A-1",
+        "D=M-D",
+        f"@{label_scope}Not{operation + str(label_number)}",
+        f"D; {jump_op}",
+        "@SP",
+        "A=M-1",
+        "M=-1",
+        f"@{label_scope}End{operation + str(label_number)}",
+        "0; JMP",
+        f"({label_scope}Not{operation + str(label_number)})",
+        "@SP",
+        "A=M-1",
+        "M=0",
+        f"({label_scope}End{operation + str(label_number)})"
+    ]
+
+
+def get_comparison_jump(operation, return_address):
+    """:returns a jump to the shared routine for operation, passing the return address in D"""
+    return [
+        f"// {operation}",
+        f"@{return_address}",
+        "D=A",
+        f"@VM${operation}",
+        "0; JMP",
+        f"({return_address})"
+    ]
+
+
+def get_comparison_routine(operation):
+    """:returns the shared routine VM$eq, VM$gt or VM$lt (named so it can not clash with Jack labels, like VM$call
+    in get_trampolines), which replaces the top 2 stack items with -1 (true) if the comparison holds, otherwise 0,
+    and returns to the address in D"""
+    jump_op = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}[operation]
+    return [
+        f"// shared {operation} routine: D = return address",
+        f"(VM${operation})",
+        "@R13",
+        "M=D",
+        "@SP",
+        "AM=M-1",
+        "D=M",
+        "A=A-1",
+        "D=M-D",
+        "M=-1",
+        f"@VM${operation}$true",
+        f"D; {jump_op}",
+        "@SP",
+        "A=M-1",
+        "M=0",
+        f"(VM${operation}$true)",
+        "@R13",
+        "A=M",
+        "0; JMP"
+    ]
+
+
+def get_push(mem_seg, index):
+
+    if mem_seg == "constant":
+        """:returns list of hack assembly instructions to push mem_seg index"""
+        return [
+            f"// push constant {index}",
+            "@" + str(index),
+            "D=A",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D"
+        ]
+    elif mem_seg == "static" or mem_seg == "temp":
+        global file_name
+        # storage can be Foo.3 or R8 if index = 3
+        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
+        return [
+            f"// push {mem_seg} {index}",
+            f"@{storage}",
+            "D=M",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D"
+        ]
+    elif mem_seg == "pointer":
+        pointer = "THIS" if index == "0" else "THAT"
+        return [
+            f"// push {mem_seg} {index}",
+            f"@{pointer}",
+            "D=M",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D"
+        ]
+    else:  # mem_seg = local, argument, this, that
+        return [
+            f"// push {mem_seg} {index}",
+            "@" + str(index),
+            "D=A",
+            "@" + mem_seg_to_pointer[mem_seg],
+            "A=D+M",
+            "D=M",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D",
+        ]
+
+
+def get_pop(mem_seg, index):
+    """:returns list of hack assembly instructions to pop mem_seg index"""
+    if mem_seg == "static" or mem_seg == "temp":
+        global file_name
+        # storage can be Foo.3 or R8 if index = 3
+        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
+        return [
+            f"// pop {mem_seg} {index}",
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            f"@{storage}",
+            "M=D"
+        ]
+    elif mem_seg == "pointer":
+        pointer = "THIS" if index == "0" else "THAT"
+        return [
+            f"// pop {mem_seg} {index}",
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            f"@{pointer}",
+            "M=D"
+        ]
+    else:   # mem_seg = local, argument, this, that
+        return [
+            f"// pop {mem_seg} {index}",
+            "@" + str(index),
+            "D=A",
+            "@" + mem_seg_to_pointer[mem_seg],
+            "D=D+M",
+            "@SP",
+            "AM=M-1",
+            "D=D+M",
+            "A=D-M",
+            "M=D-A"
+        ]
+
+
+def get_label(label_name, function_name):
+    """:returns label declaration, using Foo$bar syntax for
+    label bar in function Foo"""
+    return [
+        f"// label {label_name}",
+        f"({function_name}${label_name})"]
+
+
+def get_init():
+    asm_code = [
+        "// init",
+        "@256",
+        "D=A",
+        "@SP",
+        "M=D"
+    ]
+    return asm_code + get_call("Sys.init", "0", "init")
+
+
+def get_function(function_name, n_vars):
+    asm_code = [
+        f"// function {function_name} {n_vars}",
+        f"({function_name})"]
+    n_vars = int(n_vars)
+    if n_vars >= 1:
+        asm_code.append("@SP")
+        asm_code.append("A=M")
+        asm_code.append("M=0")
+        # repeat block
+        for i in range(n_vars - 1):
+            asm_code.append("AD=A+1")
+            asm_code.append("M=0")
+        if n_vars >= 2:
+            asm_code.append("@SP")
+            asm_code.append("M=D")
+
+    return asm_code
+
+
+def get_call(callee, n_args, caller):
+    global num_labeled
+    num_labeled += 1
+    # calls outside any function have no caller to tell files apart, so the label_scope is needed as well
+    return_address = f"{label_scope}{caller}$ret.{num_labeled}"
+    if trampolines:
+        return get_trampoline_call(callee, n_args, return_address)
+    return get_inline_call(callee, n_args, return_address)
+
+
+def get_inline_call(callee, n_args, return_address):
+    return [
+        f'// call {callee} {n_args}',
+        f'@{return_address}',
+        'D=A',
+        '@SP',
+        'A=M',
+        'M=D',
+        'D=A+1',
+        '@LCL',
+        'D=D+M',
+        'A=D-M',
+        'M=D-A',
+        'D=A+1',
+        '@ARG',
+        'D=D+M',
+        'A=D-M',
+        'M=D-A',
+        'D=A+1',
+        '@THIS',
+        'D=D+M',
+        'A=D-M',
+        'M=D-A',
+        'D=A+1',
+        '@THAT',
+        'D=D+M',
+        'A=D-M',
+        'M=D-A',
+        '@SP',
+        'D=M',
+        f'@{n_args}',
+        'D=D-A',
+        '@ARG',
+        'M=D',
+        '@5',
+        'D=A',
+        '@SP',
+        'MD=M+D',
+        '@LCL',
+        'M=D',
+        f'@{callee}',
+        '0; JMP',
+        f'({return_address})'
+    ]
+
+
+def get_trampoline_call(callee, n_args, return_address):
+    """:returns a call that passes the return address in R13, n_args in R14 and the callee in D to VM$call"""
+    return [
+        f"// call {callee} {n_args}",
+        f"@{return_address}",
+        "D=A",
+        "@R13",
+        "M=D",
+        f"@{n_args}",
+        "D=A",
+        "@R14",
+        "M=D",
+        f"@{callee}",
+        "D=A",
+        "@VM$call",
+        "0; JMP",
+        f"({return_address})"
+    ]
+
+
+def get_trampolines():
+    """:returns the shared call routine VM$call, which does the work of get_inline_call for a call from
+    get_trampoline_call, followed by the shared return routine VM$return, which is get_inline_return.
+    Jack identifiers can not contain $, and every function label has a . in it, so these labels can not clash with
+    the labels of a Jack program"""
+    return [
+        "// shared call routine: R13 = return address, R14 = number of arguments, D = callee",
+        "(VM$call)",
+        "@R15",
+        "M=D",
+        "@R13",
+        "D=M",
+        "@SP",
+        "A=M",
+        "M=D",
+        "D=A+1",
+        "@LCL",
+        "D=D+M",
+        "A=D-M",
+        "M=D-A",
+        "D=A+1",
+        "@ARG",
+        "D=D+M",
+        "A=D-M",
+        "M=D-A",
+        "D=A+1",
+        "@THIS",
+        "D=D+M",
+        "A=D-M",
+        "M=D-A",
+        "D=A+1",
+        "@THAT",
+        "D=D+M",
+        "A=D-M",
+        "M=D-A",
+        "@SP",
+        "D=M",
+        "@R14",
+        "D=D-M",
+        "@ARG",
+        "M=D",
+        "@5",
+        "D=A",
+        "@SP",
+        "MD=M+D",
+        "@LCL",
+        "M=D",
+        "@R15",
+        "A=M",
+        "0; JMP",
+        "// shared return routine",
+        "(VM$return)"
+    ] + get_inline_return()[1:]
+
+
+def get_shared_return():
+    return [
+        "// return",
+        "@VM$return",
+        "0; JMP"
+    ]
+
+
+def get_return():
+    if trampolines:
+        return get_shared_return()
+    return get_inline_return()
+
+
+def get_inline_return():
+    return [
+        '// return',
+        '@LCL',
+        'D=M',
+        '@5',
+        'A=D-A',
+        'D=M',
+        '@retAddr',
+        'M=D',
+        '@SP',
+        'A=M-1',
+        'D=M',
+        '@ARG',
+        'A=M',
+        'M=D',
+        '@ARG',
+        'D=M+1',
+        '@SP',
+        'M=D',
+        '@LCL',
+        'AM=M-1',
+        'D=M',
+        '@THAT',
+        'M=D',
+        '@LCL',
+        'AM=M-1',
+        'D=M',
+        '@THIS',
+        'M=D',
+        '@LCL',
+        'AM=M-1',
+        'D=M',
+        '@ARG',
+        'M=D',
+        '@LCL',
+        'AM=M-1',
+        'D=M',
+        '@LCL',
+        'M=D',
+        '@retAddr',
+        'A=M',
+        '0; JMP'
+    ]
+
+
+def get_goto(label_name, function_name):
+    return [
+        f"// goto {label_name}",
+        f"@{function_name}${label_name}",
+        "0; JMP"
+    ]
+
+
+def get_if_goto(label_name, function_name):
+    return [
+        f"// if-goto {label_name}",
+        "@SP",
+        "AM=M-1",
+        "D=M",
+        f"@{function_name}${label_name}",
+        "D; JNE"
+    ]
+
+
+def get_cached(command_type, arg1, arg2, current_function):
+    """:returns list of hack assembly instructions for a vm command when translating with stack caching:
+    pushes leave the value in D instead of storing it, and pops, arithmetic and if-goto use a top held in D
+    instead of reloading it. Labels, gotos, calls, returns and functions flush the top back to the stack first, so
+    the stack is in RAM wherever code can jump to"""
+    global top_in_d
+    if command_type == C_PUSH:
+        asm_instructions = get_flush() + [f"// push {arg1} {arg2}"] + get_load(arg1, arg2)
+        top_in_d = True
+    elif command_type == C_POP:
+        asm_instructions = get_cached_pop(arg1, arg2) if top_in_d else get_pop(arg1, arg2)
+        top_in_d = False
+    elif command_type == C_ARITHMETIC and arg1 in CACHED_OPERATIONS and \
+            not (shared_comparisons and arg1 in ("eq", "gt", "lt")):
+        # (with shared comparisons, comparisons flush and jump to their shared routine instead)
+        asm_instructions = [f"// {arg1}"] + ([] if top_in_d else ["@SP", "AM=M-1", "D=M"])
+        asm_instructions += get_cached_operation(arg1)
+        top_in_d = True
+    elif command_type == C_IF and top_in_d:
+        asm_instructions = [
+            f"// if-goto {arg1}",
+            f"@{current_function}${arg1}",
+            "D; JNE"
+        ]
+        top_in_d = False
+    else:
+        asm_instructions = get_flush()
+        top_in_d = False
+        if command_type == C_ARITHMETIC:
+            asm_instructions += get_arithmetic(arg1)
+        elif command_type == C_IF:
+            asm_instructions += get_if_goto(arg1, current_function)
+        elif command_type == C_RETURN:
+            asm_instructions += get_return()
+        elif command_type == C_LABEL:
+            asm_instructions += get_label(arg1, current_function)
+        elif command_type == C_GOTO:
+            asm_instructions += get_goto(arg1, current_function)
+        elif command_type == C_CALL:
+            asm_instructions += get_call(arg1, arg2, current_function)
+        elif command_type == C_FUNCTION:
+            asm_instructions += get_function(arg1, arg2)
+    return asm_instructions
+
+
+def get_fused(pattern, commands, current_function):
+    """:returns list of hack assembly instructions for a run of commands that matched FUSION_PATTERNS[pattern],
+    which move values between segments through D (and R13 for binary operations) without touching SP"""
+    global top_in_d
+    asm_instructions = get_flush() + [f"// {pattern}: " + ", ".join(describe(command) for command in commands)]
+    top_in_d = False
+    push, *rest = commands
+    asm_instructions += get_load(push[1], push[2])
+    if pattern == "push-push-op-pop" or pattern == "push-push-op":
+        second_push, operation = rest[0], rest[1][1]
+        if second_push[1] == "constant":
+            asm_instructions += ["@" + second_push[2], FUSED_CONSTANT_OPERATIONS[operation]]
+        else:
+            asm_instructions += ["@R13", "M=D"] + get_load(second_push[1], second_push[2])
+            asm_instructions += ["@R13", FUSED_OPERATIONS[operation]]
+    elif pattern == "push-op-pop":
+        asm_instructions.append(CACHED_OPERATIONS[rest[0][1]])
+    elif pattern == "push-if-goto":
+        return asm_instructions + [f"@{current_function}${rest[0][1]}", "D; JNE"]
+
+    if pattern == "push-push-op":
+        # the result is pushed, or left in D with stack caching
+        if stack_caching:
+            top_in_d = True
+            return asm_instructions
+        return asm_instructions + ["@SP", "AM=M+1", "A=A-1", "M=D"]
+    pop = commands[-1]
+    return asm_instructions + get_store(pop[1], pop[2])
+
+
+def describe(command):
+    """:returns the vm command of a parsed command, as far as fusion patterns go"""
+    command_type, arg1, arg2 = command
+    if command_type == C_PUSH or command_type == C_POP:
+        return f"{'push' if command_type == C_PUSH else 'pop'} {arg1} {arg2}"
+    elif command_type == C_IF:
+        return f"if-goto {arg1}"
+    return arg1
+
+
+def get_flush():
+    """:returns list of hack assembly instructions to store a top of the stack held in D back on the stack"""
+    if not top_in_d:
+        return []
+    return [
+        "@SP",
+        "AM=M+1",
+        "A=A-1",
+        "M=D"
+    ]
+
+
+def get_load(mem_seg, index):
+    """:returns list of hack assembly instructions to set D to mem_seg index"""
+    if mem_seg == "constant":
+        return ["@" + str(index), "D=A"]
+    elif mem_seg == "static" or mem_seg == "temp":
+        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
+        return [f"@{storage}", "D=M"]
+    elif mem_seg == "pointer":
+        return ["@THIS" if index == "0" else "@THAT", "D=M"]
+    elif index == "0":
+        return ["@" + mem_seg_to_pointer[mem_seg], "A=M", "D=M"]
+    elif index == "1":
+        return ["@" + mem_seg_to_pointer[mem_seg], "A=M+1", "D=M"]
+    return ["@" + str(index), "D=A", "@" + mem_seg_to_pointer[mem_seg], "A=D+M", "D=M"]
+
+
+def get_cached_pop(mem_seg, index):
+    """:returns list of hack assembly instructions to pop the top of the stack held in D to mem_seg index"""
+    return [f"// pop {mem_seg} {index}"] + get_store(mem_seg, index)
+
+
+def get_store(mem_seg, index):
+    """:returns list of hack assembly instructions to set mem_seg index to D (using R13 and R14 for high indexes)"""
+    asm_code = []
+    if mem_seg == "static" or mem_seg == "temp":
+        storage = file_name + str(index) if mem_seg == "static" else "R" + str(5 + int(index))
+        return asm_code + [f"@{storage}", "M=D"]
+    elif mem_seg == "pointer":
+        return asm_code + ["@THIS" if index == "0" else "@THAT", "M=D"]
+    index = int(index)
+    if index < 8:
+        # step A up to the address, as that is shorter than working it out without losing D
+        asm_code += ["@" + mem_seg_to_pointer[mem_seg], "A=M" if index == 0 else "A=M+1"]
+        return asm_code + ["A=A+1"] * (index - 1) + ["M=D"]
+    return asm_code + [
+        "@R13",
+        "M=D",
+        "@" + str(index),
+        "D=A",
+        "@" + mem_seg_to_pointer[mem_seg],
+        "D=D+M",
+        "@R14",
+        "M=D",
+        "@R13",
+        "D=M",
+        "@R14",
+        "A=M",
+        "M=D"
+    ]
+
+
+def get_cached_operation(operation):
+    """:returns list of hack assembly instructions to apply operation to the top of the stack held in D (and the
+    item below it in RAM), leaving the result in D"""
+    if operation == "neg" or operation == "not":
+        return [CACHED_OPERATIONS[operation]]
+    elif operation != "eq" and operation != "gt" and operation != "lt":
+        return ["@SP", "AM=M-1", CACHED_OPERATIONS[operation]]
+    global num_labeled
+    num_labeled += 1
+    return [
+        "@SP",
+        "AM=M-1",
+        "D=M-D",
+        f"@{label_scope}True{operation + str(num_labeled)}",
+        f"D; {CACHED_OPERATIONS[operation]}",
+        "D=0",
+        f"@{label_scope}End{operation + str(num_labeled)}",
+        "0; JMP",
+        f"({label_scope}True{operation + str(num_labeled)})",
+        "D=-1",
+        f"({label_scope}End{operation + str(num_labeled)})"
+    ]
+
+
+# vm command -> its command_type, for parse
+COMMAND_MAP = {
+    "return": C_RETURN,
+    "add": C_ARITHMETIC,
+    "sub": C_ARITHMETIC,
+    "neg": C_ARITHMETIC,
+    "eq": C_ARITHMETIC,
+    "gt": C_ARITHMETIC,
+    "lt": C_ARITHMETIC,
+    "and": C_ARITHMETIC,
+    "or": C_ARITHMETIC,
+    "not": C_ARITHMETIC,
+    "label": C_LABEL,
+    "goto": C_GOTO,
+    "if-goto": C_IF,
+    "push": C_PUSH,
+    "pop": C_POP,
+    "call": C_CALL,
+    "function": C_FUNCTION
+}
+INLINE_CALL_SIZE = count_instructions(get_inline_call("callee", "0", "return_address"))
+INLINE_RETURN_SIZE = count_instructions(get_inline_return())
+TRAMPOLINE_CALL_SIZE = count_instructions(get_trampoline_call("callee", "0", "return_address"))
+SHARED_RETURN_SIZE = count_instructions(get_shared_return())
+# operation -> the instruction computing it from D (and M) with stack caching, or the jump of a comparison
+CACHED_OPERATIONS = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M", "neg": "D=-D", "not": "D=!D",
+                     "eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+# operation -> the instruction computing it in D from the first operand at M and the second in D, for fusion
+FUSED_OPERATIONS = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}
+# and from the first operand in D and a constant second operand in A
+FUSED_CONSTANT_OPERATIONS = {"add": "D=D+A", "sub": "D=D-A", "and": "D=D&A", "or": "D=D|A"}
+# fusion pattern name -> the commands it matches, longest first, where unary is neg or not and binary is one of
+# the FUSED_OPERATIONS
+FUSION_PATTERNS = {
+    "push-push-op-pop": ["push", "push", "binary", "pop"],
+    "push-op-pop": ["push", "unary", "pop"],
+    "push-push-op": ["push", "push", "binary"],
+    "push-pop": ["push", "pop"],
+    "push-if-goto": ["push", "if-goto"],
+}
+INLINE_COMPARISON = get_inline_comparison("eq", 0)
+COMPARISON_JUMP = get_comparison_jump("eq", "return_address")
+# the jump of each kind of shared routine -> (instructions, labels) it saves over inlining the routine
+SHARED_ROUTINE_SAVINGS = {
+    "@VM$call": (INLINE_CALL_SIZE - TRAMPOLINE_CALL_SIZE, 0),
+    "@VM$return": (INLINE_RETURN_SIZE - SHARED_RETURN_SIZE, 0),
+    **{f"@VM${operation}": (count_instructions(INLINE_COMPARISON) - count_instructions(COMPARISON_JUMP),
+                             count_labels(INLINE_COMPARISON) - count_labels(COMPARISON_JUMP))
+       for operation in ("eq", "gt", "lt")},
+}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Translates vm code to hack assembly", usage=USAGE)
+    arg_parser.add_argument("file_or_dir", metavar="XXX.vm|my_directory/|-")
+    arg_parser.add_argument("--trampolines", action="store_true",
+                            help="jump to one shared call and one shared return routine rather than inlining every "
+                                 "call and return, and report the ROM size saved on stderr")
+    arg_parser.add_argument("--shared-comparisons", action="store_true",
+                            help="jump to one shared routine per operator for eq, gt and lt rather than inlining "
+                                 "them, and report the ROM size saved on stderr")
+    arg_parser.add_argument("--stack-caching", action="store_true",
+                            help="keep the top of the stack in D between commands rather than storing and "
+                                 "reloading it")
+    arg_parser.add_argument("--fusion", action="store_true",
+                            help="translate push/pop pairs and short push/operation/pop runs into direct moves that "
+                                 "do not touch the stack, and report how often each pattern was fused on stderr")
+    arg_parser.add_argument("--eliminate-dead-functions", action="store_true",
+                            help="for a whole program, only translate the functions Sys.init can call, and report "
+                                 "what was dropped on stderr")
+    arg_parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                            help="translate the files of a directory in N worker processes, with labels scoped to "
+                                 "each file so the output is the same whatever N is and however the workers finish")
+    arg_parser.add_argument("--cache", metavar="DIR",
+                            help="keep the translation of each file in DIR, keyed by its content, the translator "
+                                 "version and the options, and only translate the files that changed (labels are "
+                                 "scoped to each file as with --jobs); cache hits and misses are reported on stderr")
+    arg_parser.add_argument("--benchmark", action="store_true",
+                            help="report vm lines translated per second instead of writing the .asm file")
+    args = arg_parser.parse_args()
+    if args.benchmark and args.file_or_dir == "-":
+        arg_parser.error("--benchmark needs a .vm file or a directory")
+    main(args.file_or_dir, args.trampolines, args.shared_comparisons, args.stack_caching, args.fusion,
+         args.eliminate_dead_functions, args.jobs, args.cache, args.benchmark)